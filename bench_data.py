@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Data pipeline benchmark.
+
+Reports the time spent in each stage of the pipeline (LMDB read, decode, each augmentation op, each transform,
+collate) for a sample of the data, then the throughput of the train and val loaders of SceneTextDataModule for
+every combination of `bench.num_workers` and `bench.batch_sizes`, with per-worker fetch and collate times.
+
+Example: ./bench_data.py dataset=real 'bench.num_workers=[4,8]' bench.output=bench_data.json
+"""
+import bisect
+import copy
+import io
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import hydra
+from omegaconf import DictConfig, OmegaConf
+from PIL import Image
+
+import torch
+from torch.utils.data import ConcatDataset, Dataset, default_collate, get_worker_info
+
+from strhub.data.module import SceneTextDataModule
+
+
+class StageTimer:
+    """Accumulates the wall time of each stage."""
+
+    def __init__(self, device=None) -> None:
+        self.device = device
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def __call__(self, stage: str, count: int = 1):
+        start = time.perf_counter()
+        yield
+        if self.device is not None and self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self.totals[stage] += time.perf_counter() - start
+        self.counts[stage] += count
+
+    def report(self) -> dict:
+        return {
+            stage: {'total_s': total, 'count': self.counts[stage], 'us_per_item': 1e6 * total / self.counts[stage]}
+            for stage, total in self.totals.items()
+        }
+
+
+def _transform_name(t) -> str:
+    return getattr(t, '__name__', type(t).__name__)
+
+
+def _apply_transforms(timer: StageTimer, transforms, img):
+    for t in transforms:
+        ops = getattr(t, 'ops', None)  # timm RandAugment
+        if ops is not None:
+            # Cost of each op when applied, on top of the cost of the actual (random) selection
+            for op in ops:
+                op = copy.copy(op)
+                op.prob = 1.0
+                with timer(f'augment/{op.name}'):
+                    op(img)
+            with timer('augment'):
+                img = t(img)
+        else:
+            with timer(f'transform/{_transform_name(t)}'):
+                img = t(img)
+    return img
+
+
+def profile_stages(datamodule: SceneTextDataModule, split: str, num_samples: int, device) -> dict:
+    """Run each stage of the pipeline separately, in the current process, for `num_samples` evenly spaced samples."""
+    dataset = datamodule.train_dataset if split == 'train' else datamodule.val_dataset
+    if not isinstance(dataset, ConcatDataset):
+        return {}  # e.g. streaming dataset
+    timer = StageTimer()
+    samples = []
+    num_samples = min(num_samples, len(dataset))
+    for i in range(num_samples):
+        idx = i * len(dataset) // num_samples
+        ds_idx = bisect.bisect_right(dataset.cumulative_sizes, idx)
+        ds = dataset.datasets[ds_idx]
+        idx -= dataset.cumulative_sizes[ds_idx - 1] if ds_idx else 0
+        if ds._images is not None:
+            with timer('read_image_cache'):
+                img = torch.from_numpy(ds._images[idx])
+        else:
+            with timer('read'), ds.env.begin() as txn:
+                buf = txn.get(f'image-{ds._lmdb_index(idx):09d}'.encode())
+            with timer('decode'):
+                img = Image.open(io.BytesIO(buf)).convert('RGB')
+        transforms = getattr(ds.transform, 'transforms', [ds.transform] if ds.transform is not None else [])
+        img = _apply_transforms(timer, transforms, img)
+        samples.append((img, ds.labels[idx]))
+    batches = []
+    for i in range(0, len(samples), datamodule.batch_size):
+        batch = samples[i : i + datamodule.batch_size]
+        with timer('collate', len(batch)):
+            batches.append(default_collate(batch))
+    if split == 'train' and datamodule.batch_augment is not None:
+        augment = datamodule.batch_augment
+        batch_timer = StageTimer(device)
+        for images, _ in batches:
+            images = images.to(device)
+            n = len(images)
+            sign = torch.ones(n)
+            for name in augment.ops:
+                with batch_timer(f'batch_augment/{name}', n):
+                    augment.apply(name, images.float(), sign)
+            with batch_timer('batch_augment', n):
+                augment(images)
+        timer.totals.update(batch_timer.totals)
+        timer.counts.update(batch_timer.counts)
+    return timer.report()
+
+
+# Set by _TimedDataset and read by _TimedCollate, both of which run in the same (worker) process for a given batch.
+_last_fetch_time = 0.0
+
+
+class _TimedDataset(Dataset):
+    """Measures the time taken to fetch the samples of each batch."""
+
+    def __init__(self, dataset) -> None:
+        self.dataset = dataset
+
+    def __getattr__(self, name):
+        if name == 'dataset':  # not set yet, e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return self.dataset[index]
+
+    def __getitems__(self, indices):
+        global _last_fetch_time
+        start = time.perf_counter()
+        if hasattr(self.dataset, '__getitems__'):
+            samples = self.dataset.__getitems__(indices)
+        else:
+            samples = [self.dataset[i] for i in indices]
+        _last_fetch_time = time.perf_counter() - start
+        return samples
+
+
+class _TimedCollate:
+    """Collates the batch and attaches the worker-side timings to it."""
+
+    def __init__(self, collate_fn) -> None:
+        self.collate_fn = collate_fn
+
+    def __call__(self, samples):
+        start = time.perf_counter()
+        batch = self.collate_fn(samples)
+        collate_time = time.perf_counter() - start
+        worker_info = get_worker_info()
+        stats = {
+            'worker': -1 if worker_info is None else worker_info.id,
+            'fetch': _last_fetch_time,
+            'collate': collate_time,
+            'sent': time.time(),
+        }
+        return batch, stats
+
+
+def bench_loader(config: DictConfig, split: str, num_workers: int, batch_size: int) -> dict:
+    datamodule: SceneTextDataModule = hydra.utils.instantiate(
+        config.data, num_workers=num_workers, batch_size=batch_size
+    )
+    if split == 'train':
+        if not datamodule.streaming:  # no per-batch fetch for iterable datasets
+            datamodule._train_dataset = _TimedDataset(datamodule.train_dataset)
+    else:
+        datamodule._val_dataset = _TimedDataset(datamodule.val_dataset)
+    datamodule.collate_fn = _TimedCollate(datamodule.collate_fn or default_collate)
+    loader = datamodule.train_dataloader() if split == 'train' else datamodule.val_dataloader()
+    it = iter(loader)
+    for _ in range(config.bench.warmup_batches):
+        next(it, None)
+    workers = defaultdict(lambda: defaultdict(float))
+    num_batches = num_samples = 0
+    wait = ipc = 0.0
+    start = time.perf_counter()
+    for _ in range(config.bench.num_batches):
+        t = time.perf_counter()
+        item = next(it, None)
+        if item is None:
+            break
+        wait += time.perf_counter() - t
+        (_, labels), stats = item
+        # Time from the end of collate in the worker until the batch is available here (queue, unpickle, pinning)
+        ipc += time.time() - stats['sent']
+        w = workers[stats['worker']]
+        w['batches'] += 1
+        w['fetch_s'] += stats['fetch']
+        w['collate_s'] += stats['collate']
+        num_batches += 1
+        num_samples += len(labels)
+    elapsed = time.perf_counter() - start
+    del it, loader
+    return {
+        'split': split,
+        'num_workers': num_workers,
+        'batch_size': batch_size,
+        'batches': num_batches,
+        'samples_per_s': num_samples / elapsed if elapsed else 0.0,
+        'wait_ms_per_batch': 1e3 * wait / max(num_batches, 1),
+        'ipc_ms_per_batch': 1e3 * ipc / max(num_batches, 1),
+        'workers': {
+            str(k): {
+                'batches': int(v['batches']),
+                'fetch_ms_per_batch': 1e3 * v['fetch_s'] / v['batches'],
+                'collate_ms_per_batch': 1e3 * v['collate_s'] / v['batches'],
+            }
+            for k, v in sorted(workers.items())
+        },
+    }
+
+
+@hydra.main(config_path='configs', config_name='bench_data', version_base='1.2')
+def main(config: DictConfig):
+    device = torch.device(config.get('device', 'cuda' if torch.cuda.is_available() else 'cpu'))
+    results = {'data': OmegaConf.to_container(config.data, resolve=True), 'stages': {}, 'loaders': []}
+    datamodule: SceneTextDataModule = hydra.utils.instantiate(config.data)
+    for split in config.bench.splits:
+        results['stages'][split] = profile_stages(datamodule, split, config.bench.stage_samples, device)
+    for split in config.bench.splits:
+        for batch_size in config.bench.batch_sizes:
+            for num_workers in config.bench.num_workers:
+                result = bench_loader(config, split, num_workers, batch_size)
+                print(
+                    f'{split:>5} | batch size {batch_size:>4} | workers {num_workers:>2} | '
+                    f'{result["samples_per_s"]:>9.1f} samples/s | wait {result["wait_ms_per_batch"]:>8.2f} ms/batch'
+                )
+                results['loaders'].append(result)
+    output = json.dumps(results, indent=2)
+    if config.bench.output is None:
+        print(output)
+    else:
+        with open(config.bench.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
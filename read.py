@@ -15,6 +15,9 @@
 # limitations under the License.
 
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 from PIL import Image
 
@@ -30,6 +33,7 @@ def main():
     parser.add_argument('checkpoint', help="Model checkpoint (or 'pretrained=<model_id>')")
     parser.add_argument('--images', nargs='+', help='Images to read')
     parser.add_argument('--device', default='cuda')
+    parser.add_argument('--threads', type=int, default=4, help='Number of threads for loading the images')
     args, unknown = parser.parse_known_args()
     kwargs = parse_model_args(unknown)
     print(f'Additional keyword arguments: {kwargs}')
@@ -37,14 +41,24 @@ def main():
     model = load_from_checkpoint(args.checkpoint, **kwargs).eval().to(args.device)
     img_transform = SceneTextDataModule.get_transform(model.hparams.img_size)
 
-    for fname in args.images:
-        # Load image and prepare for input
-        image = Image.open(fname).convert('RGB')
-        image = img_transform(image).unsqueeze(0).to(args.device)
+    def load(fname):
+        # Load image and prepare for input. PIL releases the GIL, so images are decoded in parallel.
+        return img_transform(Image.open(fname).convert('RGB'))
 
-        p = model(image).softmax(-1)
-        pred, p = model.tokenizer.decode(p)
-        print(f'{fname}: {pred[0]}')
+    threads = max(args.threads, 1)
+    with ThreadPoolExecutor(threads) as executor:
+        # Only keep a few images per thread in flight, instead of loading all of them ahead of the model
+        fnames = iter(args.images)
+        pending = deque((fname, executor.submit(load, fname)) for fname in islice(fnames, 2 * threads))
+        while pending:
+            fname, image = pending.popleft()
+            next_fname = next(fnames, None)
+            if next_fname is not None:
+                pending.append((next_fname, executor.submit(load, next_fname)))
+            image = image.result().unsqueeze(0).to(args.device)
+            p = model(image).softmax(-1)
+            pred, p = model.tokenizer.decode(p)
+            print(f'{fname}: {pred[0]}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,253 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Batched counterpart of `augment.rand_augment_transform()` for collated uint8 NCHW tensors.
+
+The ops, magnitudes and selection distribution follow the PIL version (3 distinct ops per sample, each applied with
+probability 0.5). Since the images are already resized, ops are applied at the target resolution instead of the
+original one, and geometric ops always use bilinear interpolation.
+"""
+import math
+from functools import partial
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+_LEVEL_DENOM = 10.0
+_FILL = 128.0
+
+# Same as in rand_augment_transform()
+_HPARAMS = {
+    'rotate_deg': 30,
+    'shear_x_pct': 0.9,
+    'shear_y_pct': 0.2,
+    'translate_x_pct': 0.10,
+    'translate_y_pct': 0.30,
+}
+
+
+# Pixel ops: (images as float [0, 255], level in [0, 1], random sign per sample) -> images
+
+
+def _auto_contrast(img, level, sign):
+    lo = img.amin(dim=(2, 3), keepdim=True)
+    hi = img.amax(dim=(2, 3), keepdim=True)
+    out = ((img - lo) * (255 / (hi - lo).clamp(min=1))).floor()
+    return torch.where(hi > lo, out, img)
+
+
+def _equalize(img, level, sign):
+    n, c, h, w = img.shape
+    flat = img.reshape(n * c, h * w).long()
+    hist = torch.zeros(n * c, 256, device=img.device).scatter_add_(1, flat, torch.ones_like(img).view(n * c, -1))
+    # Same as PIL: the most intense color is excluded when computing the step
+    step = ((h * w - hist.gather(1, flat.amax(1, keepdim=True))) / 255).floor()
+    lut = ((hist.cumsum(1) - hist + (step / 2).floor()) / step.clamp(min=1)).floor().clamp(max=255)
+    out = torch.where(step > 0, lut.gather(1, flat), flat.float())
+    return out.view_as(img)
+
+
+def _invert(img, level, sign):
+    return 255 - img
+
+
+def _posterize(img, level, sign):
+    shift = 2 ** (8 - (4 - int(level * 4)))
+    return (img / shift).floor() * shift
+
+
+def _solarize(img, level, sign):
+    return torch.where(img >= 256 - int(level * 256), 255 - img, img)
+
+
+def _solarize_add(img, level, sign):
+    return torch.where(img < 128, (img + int(level * 110)).clamp(max=255), img)
+
+
+def _grayscale(img):
+    r, g, b = img.unbind(1)
+    return (0.299 * r + 0.587 * g + 0.114 * b).round().unsqueeze(1)
+
+
+def _enhance_factor(level, sign):
+    return (1.0 + sign * level * 0.9).clamp(min=0.1).view(-1, 1, 1, 1)
+
+
+def _color(img, level, sign):
+    gray = _grayscale(img)
+    return gray + _enhance_factor(level, sign) * (img - gray)
+
+
+def _contrast(img, level, sign):
+    mean = (_grayscale(img).mean(dim=(1, 2, 3), keepdim=True) + 0.5).floor()
+    return mean + _enhance_factor(level, sign) * (img - mean)
+
+
+def _brightness(img, level, sign):
+    return img * _enhance_factor(level, sign)
+
+
+def _size_param(level, img, max_dim_factor, min_level=1):
+    """Same as augment._get_param()"""
+    return round(min(level, max(min_level, max_dim_factor * max(img.shape[-2:]))))
+
+
+def _gaussian_blur(img, level, sign):
+    sigma = _size_param(4 * level, img, 0.02)
+    if sigma == 0:
+        return img
+    n, c, h, w = img.shape
+    r = math.ceil(3 * sigma)
+    kernel = torch.exp(-(torch.arange(-r, r + 1, device=img.device, dtype=img.dtype) ** 2) / (2 * sigma**2))
+    kernel /= kernel.sum()
+    out = F.pad(img.view(n * c, 1, h, w), (r, r, r, r), mode='replicate')
+    out = F.conv2d(out, kernel.view(1, 1, 1, -1))
+    out = F.conv2d(out, kernel.view(1, 1, -1, 1))
+    return out.view_as(img)
+
+
+def _poisson_noise(img, level, sign):
+    lam = _size_param(40 * level, img, 0.2) | 1  # bin to odd values
+    n, _, h, w = img.shape
+    noise = torch.poisson(torch.full((n, 1, h, w), float(lam), device=img.device))
+    # Same as imgaug.AdditivePoissonNoise: random sign per pixel, shared by all channels
+    noise *= torch.randint_like(noise, 2) * 2 - 1
+    return img + noise
+
+
+# Geometric ops: (image size, level in [0, 1], random sign per sample) -> inverse affine matrices (output to input
+# pixel coordinates, origin at the top-left corner) like the ones passed to PIL's Image.transform()
+
+
+def _affine(sign, a=1.0, b=0.0, c=0.0, d=0.0, e=1.0, f=0.0):
+    m = torch.eye(3, dtype=torch.float64).repeat(len(sign), 1, 1)
+    m[:, 0, 0], m[:, 0, 1], m[:, 0, 2] = a, b, c
+    m[:, 1, 0], m[:, 1, 1], m[:, 1, 2] = d, e, f
+    return m
+
+
+def _rotate(size, level, sign, max_deg):
+    """Same as aa_overrides.rotate_expand() followed by resizing back to the original size."""
+    h, w = size
+    angle = sign.double() * math.radians(level * max_deg)
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    # Size of the expanded canvas
+    exp_w = w * cos.abs() + h * sin.abs()
+    exp_h = w * sin.abs() + h * cos.abs()
+    sx, sy = exp_w / w, exp_h / h
+    # Rotate counterclockwise around the center, after scaling the output to the expanded canvas
+    a, b, d, e = cos * sx, -sin * sy, sin * sx, cos * sy
+    c = w / 2 - a * w / 2 - b * h / 2
+    f = h / 2 - d * w / 2 - e * h / 2
+    return _affine(sign, a, b, c, d, e, f)
+
+
+def _shear_x(size, level, sign, max_pct):
+    return _affine(sign, b=sign.double() * level * max_pct)
+
+
+def _shear_y(size, level, sign, max_pct):
+    return _affine(sign, d=sign.double() * level * max_pct)
+
+
+def _translate_x_rel(size, level, sign, max_pct):
+    return _affine(sign, c=sign.double() * level * max_pct * size[1])
+
+
+def _translate_y_rel(size, level, sign, max_pct):
+    return _affine(sign, f=sign.double() * level * max_pct * size[0])
+
+
+def _warp(img: Tensor, matrices: Tensor) -> Tensor:
+    """Apply pixel-space inverse affine transforms with a single grid_sample() call."""
+    n, c, h, w = img.shape
+    # Map normalized [-1, 1] coordinates (align_corners=False) to pixel coordinates and back
+    norm = torch.tensor([[w / 2, 0, w / 2], [0, h / 2, h / 2], [0, 0, 1]], dtype=torch.float64)
+    theta = torch.linalg.solve(norm, matrices @ norm)[:, :2].to(img)
+    grid = F.affine_grid(theta, [n, c, h, w], align_corners=False)
+    # Shift the range so that zero padding fills with gray, as in the PIL version
+    return F.grid_sample(img - _FILL, grid, mode='bilinear', padding_mode='zeros', align_corners=False) + _FILL
+
+
+class BatchRandAugment:
+    """RandAugment for uint8 NCHW batches.
+
+    Op selection and signs are drawn on the CPU. Samples are then grouped by op, so that each op is applied once per
+    layer to all the samples which selected it, and all geometric ops of a layer are fused into a single resampling.
+    """
+
+    def __init__(self, magnitude: int = 5, num_layers: int = 3, prob: float = 0.5, hparams: Optional[dict] = None):
+        hparams = {**_HPARAMS, **(hparams or {})}
+        self.level = min(max(magnitude, 0), _LEVEL_DENOM) / _LEVEL_DENOM
+        self.num_layers = num_layers
+        self.prob = prob
+        self.geometric_ops = {
+            'Rotate': partial(_rotate, max_deg=hparams['rotate_deg']),
+            'ShearX': partial(_shear_x, max_pct=hparams['shear_x_pct']),
+            'ShearY': partial(_shear_y, max_pct=hparams['shear_y_pct']),
+            'TranslateXRel': partial(_translate_x_rel, max_pct=hparams['translate_x_pct']),
+            'TranslateYRel': partial(_translate_y_rel, max_pct=hparams['translate_y_pct']),
+        }
+        self.pixel_ops = {
+            'AutoContrast': _auto_contrast,
+            'Equalize': _equalize,
+            'Invert': _invert,
+            'PosterizeIncreasing': _posterize,
+            'SolarizeIncreasing': _solarize,
+            'SolarizeAdd': _solarize_add,
+            'ColorIncreasing': _color,
+            'ContrastIncreasing': _contrast,
+            'BrightnessIncreasing': _brightness,
+            'GaussianBlur': _gaussian_blur,
+            'PoissonNoise': _poisson_noise,
+        }
+        self.ops = list(self.geometric_ops) + list(self.pixel_ops)
+
+    def apply(self, name: str, images: Tensor, sign: Tensor) -> Tensor:
+        """Apply a single op to all the float images, e.g. for benchmarking. `sign` is given per sample."""
+        if name in self.geometric_ops:
+            return _warp(images, self.geometric_ops[name](images.shape[-2:], self.level, sign.cpu()))
+        return self.pixel_ops[name](images, self.level, sign.to(images.device))
+
+    def __call__(self, images: Tensor) -> Tensor:
+        n = images.shape[0]
+        num_ops = len(self.ops)
+        # Distinct ops per sample (like the choice_weights in rand_augment_transform()), each applied with prob.
+        choice = torch.rand(n, num_ops).argsort(dim=1)[:, : self.num_layers]
+        choice[torch.rand(n, self.num_layers) >= self.prob] = num_ops  # skip
+        sign = torch.where(torch.rand(n, self.num_layers) < 0.5, -1.0, 1.0)
+        img = images.float()
+        for layer in range(self.num_layers):
+            ops = choice[:, layer]
+            counts = torch.bincount(ops, minlength=num_ops + 1).tolist()
+            groups = torch.argsort(ops, stable=True).split(counts)
+            warp_idx, matrices = [], []
+            for name, idx, count in zip(self.ops, groups, counts):
+                if not count:
+                    continue
+                s = sign[idx, layer]
+                if name in self.geometric_ops:
+                    warp_idx.append(idx)
+                    matrices.append(self.geometric_ops[name](img.shape[-2:], self.level, s))
+                    continue
+                idx = idx.to(img.device, non_blocking=True)
+                out = self.pixel_ops[name](img[idx], self.level, s.to(img.device, non_blocking=True))
+                img.index_copy_(0, idx, out.round_().clamp_(0, 255))
+            if warp_idx:
+                idx = torch.cat(warp_idx).to(img.device, non_blocking=True)
+                out = _warp(img[idx], torch.cat(matrices))
+                img.index_copy_(0, idx, out.round_().clamp_(0, 255))
+        return img.to(torch.uint8)
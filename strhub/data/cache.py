@@ -0,0 +1,134 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Sidecar caches stored next to each LMDB to avoid rescanning it on every run."""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Iterable, Union
+
+import lmdb
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+_LABEL_CACHE_MAGIC = b'STRLBL01'
+_LABEL_CACHE_HEADER = len(_LABEL_CACHE_MAGIC) + 2 * 8  # magic, num. of samples, num. of label bytes
+
+
+def lmdb_signature(env: lmdb.Environment) -> dict:
+    """Cheap identity of the LMDB contents. Changes whenever the database is rewritten.
+
+    The structural counters alone can stay the same across rewrites (e.g. same-length label fixes), so the
+    modification time and inode of the data file are included too. Copying the LMDB therefore invalidates its caches.
+    """
+    stat = env.stat()
+    data_stat = os.stat(os.path.join(env.path(), 'data.mdb'))
+    return {
+        'size': data_stat.st_size,
+        'mtime_ns': data_stat.st_mtime_ns,
+        'inode': data_stat.st_ino,
+        'entries': stat['entries'],
+        'pages': (stat['branch_pages'], stat['leaf_pages'], stat['overflow_pages']),
+        'last_txnid': env.info()['last_txnid'],
+    }
+
+
+def cache_key(*parts) -> str:
+    """Hash the given (JSON-serializable) parts into a short key used in cache filenames."""
+    data = json.dumps(parts, sort_keys=True).encode()
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def _write_atomic(path: Path, chunks) -> bool:
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning(f'Unable to write cache {path}: {e}')
+        tmp.unlink(missing_ok=True)
+        return False
+    return True
+
+
+def save_label_cache(path: Union[str, Path], indices: np.ndarray, offsets: np.ndarray, data: np.ndarray) -> bool:
+    """Store the filtered LMDB indices and their packed labels (see dataset.PackedLabels) in a single flat file.
+
+    Layout: magic, N, num. of label bytes, N x int64 indices, (N + 1) x int64 label offsets, UTF-8 label bytes.
+    """
+    header = np.array([len(indices), len(data)], dtype=np.int64)
+    chunks = (
+        _LABEL_CACHE_MAGIC,
+        header.tobytes(),
+        np.ascontiguousarray(indices, dtype=np.int64).tobytes(),
+        np.ascontiguousarray(offsets, dtype=np.int64).tobytes(),
+        np.ascontiguousarray(data, dtype=np.uint8).tobytes(),
+    )
+    return _write_atomic(Path(path), chunks)
+
+
+def load_label_cache(path: Union[str, Path]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Memory-map a label cache written by `save_label_cache()`.
+
+    Returns:
+        Read-only (indices, offsets, data) arrays backed by the file, so they are shared by all processes using them.
+
+    Raises:
+        FileNotFoundError: if the cache does not exist yet.
+        ValueError: if the file is not a valid label cache.
+    """
+    buf = np.memmap(path, dtype=np.uint8, mode='r')
+    if len(buf) < _LABEL_CACHE_HEADER or buf[: len(_LABEL_CACHE_MAGIC)].tobytes() != _LABEL_CACHE_MAGIC:
+        raise ValueError(f'Invalid label cache: {path}')
+    num_samples, num_bytes = buf[len(_LABEL_CACHE_MAGIC) : _LABEL_CACHE_HEADER].view(np.int64)
+    start = _LABEL_CACHE_HEADER
+    end = start + 8 * num_samples
+    indices = buf[start:end].view(np.int64)
+    start, end = end, end + 8 * (num_samples + 1)
+    offsets = buf[start:end].view(np.int64)
+    data = buf[end:]
+    if len(data) != num_bytes or len(offsets) != num_samples + 1:
+        raise ValueError(f'Truncated label cache: {path}')
+    return indices, offsets, data
+
+
+def save_image_cache(path: Union[str, Path], images: Iterable[np.ndarray], shape: tuple[int, ...]) -> bool:
+    """Write pre-decoded images into a single .npy file of the given shape, e.g. (N, H, W, 3)."""
+    path = Path(path)
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        array = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=shape)
+        for i, img in enumerate(images):
+            array[i] = img
+        array.flush()
+        del array
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning(f'Unable to write cache {path}: {e}')
+        tmp.unlink(missing_ok=True)
+        return False
+    return True
+
+
+def load_image_cache(path: Union[str, Path]) -> np.ndarray:
+    """Memory-map an image cache written by `save_image_cache()`.
+
+    The copy-on-write mode makes the array writable (as torch.from_numpy() expects) without ever modifying the file.
+    """
+    return np.load(path, mmap_mode='c')
@@ -12,39 +12,260 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import bisect
 import glob
 import io
 import logging
+import multiprocessing
+import os
+import struct
+import threading
 import unicodedata
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from pathlib import Path, PurePath
 from typing import Callable, Optional, Union
 
 import lmdb
+import numpy as np
 from PIL import Image
 
+import torch
 from torch.utils.data import ConcatDataset, Dataset
 
+from strhub.data.cache import (
+    cache_key,
+    lmdb_signature,
+    load_image_cache,
+    load_label_cache,
+    save_image_cache,
+    save_label_cache,
+)
 from strhub.data.utils import CharsetAdapter
 
 log = logging.getLogger(__name__)
 
+_decode_pool_lock = threading.Lock()
+_decode_pool = None  # (pid, max_workers, executor)
 
-def build_tree_dataset(root: Union[PurePath, str], *args, **kwargs):
+
+def image_size(buf: bytes) -> tuple[int, int]:
+    """Get the (width, height) of an encoded image by parsing its header only.
+
+    PNG and JPEG headers are parsed directly. Other formats fall back to PIL, which also stops at the header.
+    """
+    if buf[:8] == b'\x89PNG\r\n\x1a\n':
+        return struct.unpack('>II', buf[16:24])
+    if buf[:2] == b'\xff\xd8':
+        i = 2
+        while i + 9 <= len(buf) and buf[i] == 0xFF:
+            marker = buf[i + 1]
+            if marker == 0xFF:  # fill byte
+                i += 1
+            elif marker == 0x01 or 0xD0 <= marker <= 0xD8:  # standalone markers
+                i += 2
+            elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):  # start of frame
+                h, w = struct.unpack('>HH', buf[i + 5 : i + 9])
+                return w, h
+            else:
+                i += 2 + struct.unpack('>H', buf[i + 2 : i + 4])[0]
+    return Image.open(io.BytesIO(buf)).size
+
+
+def preprocess_label(
+    label: str,
+    charset_adapter: CharsetAdapter,
+    max_label_len: int,
+    remove_whitespace: bool = True,
+    normalize_unicode: bool = True,
+) -> str:
+    """Transform a raw label according to the dataset settings. Returns an empty string if the label is filtered."""
+    # Normally, whitespace is removed from the labels.
+    if remove_whitespace:
+        label = ''.join(label.split())
+    # Normalize unicode composites (if any) and convert to compatible ASCII characters
+    if normalize_unicode:
+        label = unicodedata.normalize('NFKD', label).encode('ascii', 'ignore').decode()
+    # Filter by length before removing unsupported characters. The original label might be too long.
+    if len(label) > max_label_len:
+        return ''
+    return charset_adapter(label)
+
+
+class PackedLabels(Sequence):
+    """Read-only sequence of labels packed into a single UTF-8 buffer, delimited by an array of N + 1 offsets.
+
+    Unlike a list of str, reading a label doesn't touch the refcounts of stored objects. Pages inherited by forked
+    DataLoader workers (or memory-mapped from the label cache) thus stay shared instead of being copied on read.
+    """
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray) -> None:
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_list(cls, labels: list[str]) -> 'PackedLabels':
+        encoded = [label.encode() for label in labels]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('label index out of range')
+        start, end = self.offsets[index : index + 2].tolist()
+        return self.data[start:end].tobytes().decode()
+
+    def lengths(self) -> np.ndarray:
+        """Number of characters of each label, computed without decoding."""
+        # Count all bytes except UTF-8 continuation bytes (0b10xxxxxx)
+        counts = np.zeros(len(self.data) + 1, dtype=np.int64)
+        np.cumsum((self.data & 0xC0) != 0x80, out=counts[1:])
+        return counts[self.offsets[1:]] - counts[self.offsets[:-1]]
+
+
+def get_decode_pool(num_threads: int) -> ThreadPoolExecutor:
+    """Thread pool shared by all datasets of the current process for decoding and transforming images.
+
+    PIL releases the GIL while decoding and resizing, so threads give multi-core throughput without extra processes.
+    Forked processes (e.g. DataLoader workers) get their own pool, since threads don't survive a fork.
+    """
+    global _decode_pool
+    with _decode_pool_lock:
+        pid = os.getpid()
+        if _decode_pool is None or _decode_pool[0] != pid or _decode_pool[1] < num_threads:
+            if _decode_pool is not None and _decode_pool[0] == pid:
+                _decode_pool[2].shutdown(wait=False)
+            _decode_pool = (pid, num_threads, ThreadPoolExecutor(num_threads, thread_name_prefix='decode'))
+        return _decode_pool[2]
+
+
+def open_lmdb(root: str) -> lmdb.Environment:
+    """Open an LMDB for reading only, in the least intrusive way."""
+    return lmdb.open(root, max_readers=1, readonly=True, create=False, readahead=False, meminit=False, lock=False)
+
+
+class LmdbEnvPool:
+    """Per-process pool of LMDB environments, keeping at most `max_open` of them open.
+
+    Environments are opened on first use. When the limit is reached, the least recently used one is closed and will be
+    reopened on demand. This bounds the number of file descriptors and mmaps, e.g. for trees of thousands of LMDBs
+    where each DataLoader worker would otherwise end up with all of them open. Environments inherited from the parent
+    process (fork) are never used.
+    """
+
+    def __init__(self, max_open: int = 128) -> None:
+        self.max_open = max_open
+        self._envs = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _own_envs(self) -> OrderedDict:
+        if self._pid != os.getpid():
+            self._envs = OrderedDict()
+            self._pid = os.getpid()
+        return self._envs
+
+    def _evict(self, limit: int) -> None:
+        while self._envs and len(self._envs) > limit:
+            self._envs.popitem(last=False)[1].close()
+
+    def resize(self, max_open: int) -> None:
+        """Change the limit, closing the least recently used environments if there are too many open."""
+        with self._lock:
+            self.max_open = max_open
+            self._own_envs()
+            self._evict(max_open)
+
+    def get(self, root: str) -> lmdb.Environment:
+        with self._lock:
+            env = self._own_envs().get(root)
+            if env is None:
+                self._evict(self.max_open - 1)
+                env = self._envs[root] = open_lmdb(root)
+            else:
+                self._envs.move_to_end(root)
+            return env
+
+
+_env_pool = LmdbEnvPool()
+
+
+def configure_env_pool(max_open: int) -> None:
+    """Set the max. number of LMDBs kept open per process. Inherited by forked processes, e.g. DataLoader workers."""
+    _env_pool.resize(max_open)
+
+
+def _load_lmdb_dataset(root: str, args: tuple, kwargs: dict) -> 'LmdbDataset':
+    return LmdbDataset(root, *args, **kwargs)
+
+
+def build_tree_dataset(root: Union[PurePath, str], *args, scan_workers: Optional[int] = None, **kwargs):
+    """Concatenate all LMDBs found under `root`.
+
+    The LMDBs are scanned concurrently using up to `scan_workers` processes (default: number of CPUs), unless all of
+    them have label caches, which are faster to load serially than to start the processes.
+    The sub-datasets are always ordered by their path relative to `root`.
+    """
     try:
         kwargs.pop('root')  # prevent 'root' from being passed via kwargs
     except KeyError:
         pass
+    # The transform is not necessarily picklable (e.g. lambdas), so it is attached after scanning.
+    transform = kwargs.pop('transform', None)
     root = Path(root).absolute()
     log.info(f'dataset root:\t{root}')
-    datasets = []
-    for mdb in glob.glob(str(root / '**/data.mdb'), recursive=True):
-        mdb = Path(mdb)
-        ds_name = str(mdb.parent.relative_to(root))
-        ds_root = str(mdb.parent.absolute())
-        dataset = LmdbDataset(ds_root, *args, **kwargs)
+    ds_roots = sorted(str(Path(mdb).parent.absolute()) for mdb in glob.glob(str(root / '**/data.mdb'), recursive=True))
+    max_workers = min(len(ds_roots), scan_workers or os.cpu_count() or 1)
+    if kwargs.get('label_cache') and all(glob.glob(os.path.join(glob.escape(r), 'labels-*.cache')) for r in ds_roots):
+        max_workers = 1
+    if max_workers > 1:
+        # Forking a process which already runs threads (e.g. CUDA, the DataLoader pin memory thread) can deadlock
+        mp_context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers, mp_context=mp_context) as executor:
+            datasets = list(executor.map(_load_lmdb_dataset, ds_roots, repeat(args), repeat(kwargs)))
+    else:
+        datasets = [_load_lmdb_dataset(ds_root, args, kwargs) for ds_root in ds_roots]
+    for ds_root, dataset in zip(ds_roots, datasets):
+        dataset.transform = transform
+        ds_name = str(Path(ds_root).relative_to(root))
         log.info(f'\tlmdb:\t{ds_name}\tnum samples: {len(dataset)}')
-        datasets.append(dataset)
-    return ConcatDataset(datasets)
+    return ConcatLmdbDataset(datasets)
+
+
+class ConcatLmdbDataset(ConcatDataset):
+    """ConcatDataset which forwards batched fetches (`__getitems__`) to the sub-datasets, one call per sub-dataset."""
+
+    def __getitems__(self, indices: list[int]) -> list:
+        groups = {}
+        for pos, idx in enumerate(indices):
+            if idx < 0:
+                idx += len(self)
+            ds_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+            sample_idx = idx - self.cumulative_sizes[ds_idx - 1] if ds_idx else idx
+            positions, sample_indices = groups.setdefault(ds_idx, ([], []))
+            positions.append(pos)
+            sample_indices.append(sample_idx)
+        samples = [None] * len(indices)
+        for ds_idx, (positions, sample_indices) in groups.items():
+            dataset = self.datasets[ds_idx]
+            if hasattr(dataset, '__getitems__'):
+                fetched = dataset.__getitems__(sample_indices)
+            else:
+                fetched = [dataset[i] for i in sample_indices]
+            for pos, sample in zip(positions, fetched):
+                samples[pos] = sample
+        return samples
+
+    def label_lengths(self) -> np.ndarray:
+        return np.concatenate([ds.label_lengths() for ds in self.datasets])
 
 
 class LmdbDataset(Dataset):
@@ -53,6 +274,22 @@ class LmdbDataset(Dataset):
     It supports both labelled and unlabelled datasets. For unlabelled datasets, the image index itself is returned
     as the label. Unicode characters are normalized by default. Case-sensitivity is inferred from the charset.
     Labels are transformed according to the charset.
+
+    Samples smaller than `min_image_dim` are filtered using the `size-index` record (see tools/create_lmdb_dataset.py)
+    if present. Otherwise, the image headers are parsed to get the sizes.
+
+    If `label_cache` is enabled, the filtered indices and transformed labels are stored in a sidecar file next to the
+    LMDB, keyed on the LMDB contents and the label preprocessing settings. Subsequent runs load it instead of
+    rescanning.
+
+    The environment is taken from a per-process pool which keeps a bounded number of LMDBs open (see LmdbEnvPool and
+    `configure_env_pool()`).
+
+    If `decode_threads` > 1, the images of a batch fetched through `__getitems__()` (i.e. by the DataLoader) are
+    decoded and transformed concurrently in a thread pool (see `get_decode_pool()`).
+
+    For non-augmented datasets, `cache_images()` can be used to decode and resize all images once into a memory-mapped
+    array, which then replaces per-sample decoding.
     """
 
     def __init__(
@@ -65,84 +302,181 @@ class LmdbDataset(Dataset):
         normalize_unicode: bool = True,
         unlabelled: bool = False,
         transform: Optional[Callable] = None,
+        label_cache: bool = False,
+        decode_threads: int = 0,
     ):
-        self._env = None
+        self._images = None
+        self._cache_parts = None
         self.root = root
         self.unlabelled = unlabelled
         self.transform = transform
-        self.labels = []
-        self.filtered_index_list = []
+        self.decode_threads = decode_threads
+        self._label_cache_path = None
+        self.labels = PackedLabels.from_list([])
+        self.filtered_index_list = np.zeros(0, dtype=np.int64)
         self.num_samples = self._preprocess_labels(
-            charset, remove_whitespace, normalize_unicode, max_label_len, min_image_dim
+            charset, remove_whitespace, normalize_unicode, max_label_len, min_image_dim, label_cache
         )
 
-    def __del__(self):
-        if self._env is not None:
-            self._env.close()
-            self._env = None
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Memory-mapped labels are mapped again instead of being copied (e.g. from the scanning processes)
+        if self._label_cache_path is not None:
+            state['labels'] = state['filtered_index_list'] = None
+        return state
 
-    def _create_env(self):
-        return lmdb.open(
-            self.root, max_readers=1, readonly=True, create=False, readahead=False, meminit=False, lock=False
-        )
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._label_cache_path is not None:
+            self._load_label_cache(self._label_cache_path)
+
+    def _load_label_cache(self, path):
+        indices, offsets, data = load_label_cache(path)
+        self.filtered_index_list = indices
+        self.labels = PackedLabels(offsets, data)
+        self._label_cache_path = path
 
     @property
     def env(self):
-        if self._env is None:
-            self._env = self._create_env()
-        return self._env
+        """The environment, from the shared pool. Don't hold on to it: it may be closed once others get opened."""
+        return _env_pool.get(self.root)
 
-    def _preprocess_labels(self, charset, remove_whitespace, normalize_unicode, max_label_len, min_image_dim):
+    def _preprocess_labels(
+        self, charset, remove_whitespace, normalize_unicode, max_label_len, min_image_dim, label_cache=False
+    ):
         charset_adapter = CharsetAdapter(charset)
-        with self._create_env() as env, env.begin() as txn:
+        with open_lmdb(self.root) as env, env.begin() as txn:
             num_samples = int(txn.get('num-samples'.encode()))
             if self.unlabelled:
+                self._cache_parts = (lmdb_signature(env), 'unlabelled')
                 return num_samples
+            self._cache_parts = (
+                lmdb_signature(env), charset, max_label_len, min_image_dim, remove_whitespace, normalize_unicode
+            )
+            cache_path = None
+            if label_cache:
+                key = cache_key(*self._cache_parts)
+                cache_path = os.path.join(self.root, f'labels-{key}.cache')
+                try:
+                    self._load_label_cache(cache_path)
+                    return len(self.labels)
+                except FileNotFoundError:
+                    pass
+                except ValueError as e:
+                    log.warning(f'{e}. Rebuilding.')
+            labels = []
+            indices = []
             for index in range(num_samples):
                 index += 1  # lmdb starts with 1
                 label_key = f'label-{index:09d}'.encode()
                 label = txn.get(label_key).decode()
-                # Normally, whitespace is removed from the labels.
-                if remove_whitespace:
-                    label = ''.join(label.split())
-                # Normalize unicode composites (if any) and convert to compatible ASCII characters
-                if normalize_unicode:
-                    label = unicodedata.normalize('NFKD', label).encode('ascii', 'ignore').decode()
-                # Filter by length before removing unsupported characters. The original label might be too long.
-                if len(label) > max_label_len:
-                    continue
-                label = charset_adapter(label)
+                label = preprocess_label(label, charset_adapter, max_label_len, remove_whitespace, normalize_unicode)
                 # We filter out samples which don't contain any supported characters
                 if not label:
                     continue
-                # Filter images that are too small.
-                if min_image_dim > 0:
-                    img_key = f'image-{index:09d}'.encode()
-                    buf = io.BytesIO(txn.get(img_key))
-                    w, h = Image.open(buf).size
-                    if w < self.min_image_dim or h < self.min_image_dim:
-                        continue
-                self.labels.append(label)
-                self.filtered_index_list.append(index)
+                labels.append(label)
+                indices.append(index)
+            indices = np.asarray(indices, dtype=np.int64)
+            # Filter images that are too small.
+            if min_image_dim > 0:
+                keep = self._filter_small_images(txn, indices, min_image_dim, num_samples)
+                labels = [label for label, k in zip(labels, keep.tolist()) if k]
+                indices = indices[keep]
+        self.labels = PackedLabels.from_list(labels)
+        self.filtered_index_list = indices
+        if cache_path is not None and save_label_cache(cache_path, indices, self.labels.offsets, self.labels.data):
+            # Share the pages of the cache rather than keeping a private copy
+            self._load_label_cache(cache_path)
         return len(self.labels)
 
+    @staticmethod
+    def _filter_small_images(txn, indices, min_image_dim, num_samples):
+        size_index = txn.get('size-index'.encode())
+        # Not updated by tools which append to or filter an LMDB
+        if size_index is not None and len(size_index) != 8 * num_samples:
+            log.warning(f'size-index does not match the {num_samples} samples. Parsing the image headers instead.')
+            size_index = None
+        if size_index is not None:
+            sizes = np.frombuffer(size_index, dtype='<u4').reshape(-1, 2)[indices - 1]
+        else:
+            sizes = [image_size(txn.get(f'image-{index:09d}'.encode())) for index in indices.tolist()]
+            sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+        return (sizes >= min_image_dim).all(axis=1)
+
     def __len__(self):
         return self.num_samples
 
-    def __getitem__(self, index):
+    def label_lengths(self) -> np.ndarray:
+        """Lengths of the transformed labels, e.g. for grouping samples by label length."""
+        return self.labels.lengths()
+
+    def _lmdb_index(self, index):
+        return index if self.unlabelled else int(self.filtered_index_list[index])
+
+    def _decode_images(self):
+        with self.env.begin() as txn:
+            for index in range(self.num_samples):
+                img_key = f'image-{self._lmdb_index(index):09d}'.encode()
+                yield Image.open(io.BytesIO(txn.get(img_key))).convert('RGB')
+
+    def cache_images(
+        self, img_size: tuple[int, int], resize: Callable, tag: str, transform: Optional[Callable] = None
+    ) -> bool:
+        """Decode all images once and store them, already resized, in an (N, H, W, 3) uint8 array next to the LMDB.
+
+        Args:
+            img_size: (height, width) of the images output by `resize`
+            resize: maps a decoded PIL image to a PIL image of `img_size`. Must be deterministic.
+            tag: identifies `resize`. Used as part of the cache key.
+            transform: replaces the current transform if caching succeeds. Receives uint8 HWC tensors.
+
+        Returns:
+            True if the cache is in use.
+        """
+        key = cache_key(*self._cache_parts, 'images', img_size, tag)
+        path = os.path.join(self.root, f'images-{key}.npy')
+        if not os.path.exists(path):
+            images = (np.asarray(resize(img)) for img in self._decode_images())
+            if not save_image_cache(path, images, (self.num_samples, *img_size, 3)):
+                return False
+        self._images = load_image_cache(path)
+        self.transform = transform
+        return True
+
+    def _get_sample(self, index, imgbuf=None):
         if self.unlabelled:
             label = index
         else:
             label = self.labels[index]
-            index = self.filtered_index_list[index]
 
-        img_key = f'image-{index:09d}'.encode()
-        with self.env.begin() as txn:
-            imgbuf = txn.get(img_key)
-        buf = io.BytesIO(imgbuf)
-        img = Image.open(buf).convert('RGB')
+        if self._images is not None:
+            img = torch.from_numpy(self._images[index])
+        else:
+            buf = io.BytesIO(imgbuf)
+            img = Image.open(buf).convert('RGB')
 
         if self.transform is not None:
             img = self.transform(img)
 
         return img, label
+
+    def __getitem__(self, index):
+        imgbuf = None
+        if self._images is None:
+            img_key = f'image-{self._lmdb_index(index):09d}'.encode()
+            with self.env.begin() as txn:
+                imgbuf = txn.get(img_key)
+        return self._get_sample(index, imgbuf)
+
+    def __getitems__(self, indices: list[int]) -> list:
+        """Fetch a whole mini-batch using a single read transaction. Used by the DataLoader if available."""
+        if self._images is not None:
+            return [self._get_sample(index) for index in indices]
+        keys = [f'image-{self._lmdb_index(index):09d}'.encode() for index in indices]
+        with self.env.begin() as txn, txn.cursor() as cursor:
+            # Sorted keys are read in B-tree order, which improves locality.
+            imgbufs = dict(cursor.getmulti(sorted(set(keys))))
+        imgbufs = [imgbufs[key] for key in keys]
+        if self.decode_threads > 1 and len(indices) > 1:
+            return list(get_decode_pool(self.decode_threads).map(self._get_sample, indices, imgbufs))
+        return [self._get_sample(index, imgbuf) for index, imgbuf in zip(indices, imgbufs)]
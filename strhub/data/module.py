@@ -13,15 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from pathlib import PurePath
+import logging
+from pathlib import Path, PurePath
 from typing import Callable, Optional, Sequence
 
-from torch.utils.data import DataLoader
+import numpy as np
+
+import torch
+from torch.utils.data import ConcatDataset, DataLoader, DistributedSampler, SequentialSampler
 from torchvision import transforms as T
 
 import pytorch_lightning as pl
 
-from .dataset import LmdbDataset, build_tree_dataset
+from .dataset import LmdbDataset, build_tree_dataset, configure_env_pool
+from .sampler import BucketBatchSampler, MixtureSampler, ResumableSampler, _random_seed
+from .shards import ShardDataset
+
+log = logging.getLogger(__name__)
 
 
 class SceneTextDataModule(pl.LightningDataModule):
@@ -46,6 +54,18 @@ class SceneTextDataModule(pl.LightningDataModule):
         min_image_dim: int = 0,
         rotation: int = 0,
         collate_fn: Optional[Callable] = None,
+        label_cache: bool = False,
+        image_cache: bool = False,
+        bucket_pool_size: int = 0,
+        streaming: bool = False,
+        shuffle_buffer: int = 10000,
+        batch_augment: bool = False,
+        uint8_images: bool = False,
+        mixture: Optional[dict[str, float]] = None,
+        epoch_samples: Optional[int] = None,
+        seed: Optional[int] = None,
+        decode_threads: int = 0,
+        max_open_lmdbs: int = 128,
     ):
         super().__init__()
         self.root_dir = root_dir
@@ -62,45 +82,123 @@ class SceneTextDataModule(pl.LightningDataModule):
         self.min_image_dim = min_image_dim
         self.rotation = rotation
         self.collate_fn = collate_fn
+        self.label_cache = label_cache
+        self.image_cache = image_cache
+        self.bucket_pool_size = bucket_pool_size
+        self.streaming = streaming
+        self.shuffle_buffer = shuffle_buffer
+        self.batch_augment = None
+        if augment and batch_augment:
+            from .batch_augment import BatchRandAugment
+
+            self.batch_augment = BatchRandAugment()
+        # Batch augmentation works on uint8 images too
+        self.uint8_images = uint8_images or self.batch_augment is not None
+        if streaming and mixture:
+            # Record shards are read sequentially, not through a sampler which could apply the weights
+            raise ValueError('mixture is not supported with streaming. Unset one of them.')
+        self.mixture = mixture
+        self.epoch_samples = epoch_samples
+        self.seed = seed
+        self.decode_threads = decode_threads
+        self.max_open_lmdbs = max_open_lmdbs
+        configure_env_pool(max_open_lmdbs)
+        self._resume_state = None
         self._train_dataset = None
         self._val_dataset = None
 
     @staticmethod
-    def get_transform(img_size: tuple[int], augment: bool = False, rotation: int = 0):
+    def _resize_transforms(img_size: tuple[int], rotation: int = 0):
+        transforms = []
+        if rotation:
+            transforms.append(lambda img: img.rotate(rotation, expand=True))
+        transforms.append(T.Resize(img_size, T.InterpolationMode.BICUBIC))
+        return transforms
+
+    @staticmethod
+    def get_transform(img_size: tuple[int], augment: bool = False, rotation: int = 0, uint8: bool = False):
         transforms = []
         if augment:
             from .augment import rand_augment_transform
 
             transforms.append(rand_augment_transform())
-        if rotation:
-            transforms.append(lambda img: img.rotate(rotation, expand=True))
-        transforms.extend([
-            T.Resize(img_size, T.InterpolationMode.BICUBIC),
-            T.ToTensor(),
-            T.Normalize(0.5, 0.5),
-        ])
+        transforms.extend(SceneTextDataModule._resize_transforms(img_size, rotation))
+        if uint8:
+            # 4x smaller than float32 for IPC and host-to-device copies. Normalized by BaseSystem.preprocess().
+            transforms.append(T.PILToTensor())
+        else:
+            transforms.extend([
+                T.ToTensor(),
+                T.Normalize(0.5, 0.5),
+            ])
         return T.Compose(transforms)
 
+    @staticmethod
+    def get_cached_transform(uint8: bool = False):
+        """Equivalent of the final ToTensor() + Normalize() of `get_transform()` for cached uint8 HWC tensors."""
+        transforms = [lambda img: img.permute(2, 0, 1)]
+        if not uint8:
+            transforms.extend([
+                T.ConvertImageDtype(torch.float),
+                T.Normalize(0.5, 0.5),
+            ])
+        return T.Compose(transforms)
+
+    def _cache_images(self, dataset, rotation: int = 0):
+        """Use pre-decoded, pre-resized images for a non-augmented dataset (see LmdbDataset.cache_images()).
+
+        Under DDP, the caches are built by rank 0 while the other ranks wait, then loaded by them. Ranks which can't
+        see the files of rank 0 (no shared filesystem) build their own.
+        """
+        resize = T.Compose(self._resize_transforms(self.img_size, rotation))
+        transform = self.get_cached_transform(self.uint8_images)
+        datasets = dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset]
+        num_replicas, rank = self._world()
+        if rank == 0:
+            for ds in datasets:
+                ds.cache_images(self.img_size, resize, f'bicubic-rot{rotation}', transform)
+        if num_replicas > 1:
+            self.trainer.strategy.barrier('image_cache')
+        if rank > 0:
+            for ds in datasets:
+                ds.cache_images(self.img_size, resize, f'bicubic-rot{rotation}', transform)
+
     @property
     def train_dataset(self):
         if self._train_dataset is None:
-            transform = self.get_transform(self.img_size, self.augment)
+            augment = self.augment and self.batch_augment is None
+            transform = self.get_transform(self.img_size, augment, uint8=self.uint8_images)
             root = PurePath(self.root_dir, 'train', self.train_dir)
-            self._train_dataset = build_tree_dataset(
-                root,
-                self.charset_train,
-                self.max_label_length,
-                self.min_image_dim,
-                self.remove_whitespace,
-                self.normalize_unicode,
-                transform=transform,
-            )
+            if self.streaming:
+                self._train_dataset = ShardDataset(
+                    root,
+                    self.charset_train,
+                    self.max_label_length,
+                    self.min_image_dim,
+                    self.remove_whitespace,
+                    self.normalize_unicode,
+                    transform=transform,
+                    shuffle_buffer=self.shuffle_buffer,
+                    seed=self._resolve_seed(),
+                )
+            else:
+                self._train_dataset = build_tree_dataset(
+                    root,
+                    self.charset_train,
+                    self.max_label_length,
+                    self.min_image_dim,
+                    self.remove_whitespace,
+                    self.normalize_unicode,
+                    transform=transform,
+                    label_cache=self.label_cache,
+                    decode_threads=self.decode_threads,
+                )
         return self._train_dataset
 
     @property
     def val_dataset(self):
         if self._val_dataset is None:
-            transform = self.get_transform(self.img_size)
+            transform = self.get_transform(self.img_size, uint8=self.uint8_images)
             root = PurePath(self.root_dir, 'val')
             self._val_dataset = build_tree_dataset(
                 root,
@@ -110,14 +208,115 @@ class SceneTextDataModule(pl.LightningDataModule):
                 self.remove_whitespace,
                 self.normalize_unicode,
                 transform=transform,
+                label_cache=self.label_cache,
+                decode_threads=self.decode_threads,
             )
+            if self.image_cache:
+                self._cache_images(self._val_dataset)
         return self._val_dataset
 
+    def _mixture_weights(self, dataset: ConcatDataset) -> np.ndarray:
+        """Resolve `mixture` (LMDB dir relative to the train dir -> weight) into one weight per sub-dataset.
+
+        A key matches the LMDBs at or below it, the most specific key winning. Its weight is split among the LMDBs it
+        matches in proportion to their size. LMDBs not matched by any key are not sampled.
+        """
+        root = Path(self.root_dir, 'train', self.train_dir).absolute()
+        groups = {}
+        for i, ds in enumerate(dataset.datasets):
+            name = Path(ds.root).relative_to(root).as_posix()
+            matches = [k for k in self.mixture if name == k.strip('/') or name.startswith(k.strip('/') + '/')]
+            if not matches:
+                log.warning(f'{name} does not match any mixture key. It will not be sampled.')
+                continue
+            groups.setdefault(max(matches, key=len), []).append(i)
+        weights = np.zeros(len(dataset.datasets))
+        for key, members in groups.items():
+            sizes = np.array([len(dataset.datasets[i]) for i in members], dtype=np.float64)
+            if sizes.sum() > 0:
+                weights[members] = self.mixture[key] * sizes / sizes.sum()
+        return weights
+
+    def _world(self) -> tuple[int, int]:
+        if self.trainer is None:
+            return 1, 0
+        return self.trainer.world_size, self.trainer.global_rank
+
+    def _resolve_seed(self) -> int:
+        """Draw a random seed if none was given, once, and share the one of rank 0 so that all ranks agree."""
+        if self.seed is None:
+            seed = _random_seed()
+            if self.trainer is not None:
+                seed = self.trainer.strategy.broadcast(seed)
+            self.seed = seed
+        return self.seed
+
+    def _sampler(self, dataset, shuffle: bool):
+        """Sampler for the given dataset, sharded across DDP ranks by the datamodule itself.
+
+        This way, the samplers are the same regardless of how (and if) Lightning injects its own.
+        """
+        num_replicas, rank = self._world()
+        if shuffle and self.mixture:
+            weights = self._mixture_weights(dataset)
+            return MixtureSampler(dataset, weights, self.epoch_samples, num_replicas, rank, self.seed)
+        if shuffle:
+            # Deterministic per epoch (unlike RandomSampler), for resuming mid-epoch
+            return ResumableSampler(dataset, num_replicas, rank, shuffle=True, seed=self.seed)
+        if num_replicas > 1:
+            return DistributedSampler(dataset, num_replicas, rank, shuffle=False)
+        return SequentialSampler(dataset)
+
+    def _batch_sampler(self, dataset, shuffle: bool):
+        """Group samples of similar label length (in pools of `bucket_pool_size` batches) to reduce padding."""
+        sampler = self._sampler(dataset, shuffle)
+        return BucketBatchSampler(
+            sampler,
+            self.batch_size,
+            False,
+            dataset.label_lengths(),
+            self.bucket_pool_size,
+            shuffle=shuffle,
+            seed=self.seed,
+        )
+
+    def state_dict(self):
+        """Position in the training data, saved in checkpoints to resume mid-epoch."""
+        if self.trainer is None:
+            return {}
+        return {
+            'epoch': self.trainer.current_epoch,
+            'batches': self.trainer.fit_loop.epoch_loop.batch_progress.current.completed,
+            'seed': self.seed,
+        }
+
+    def load_state_dict(self, state_dict):
+        if state_dict:
+            self.seed = state_dict['seed']
+            self._resume_state = state_dict
+
     def train_dataloader(self):
+        resume, self._resume_state = self._resume_state, None
+        # Restored from the checkpoint when resuming
+        self._resolve_seed()
+        if self.streaming:
+            # Shuffling is done by the dataset itself.
+            batching = dict(batch_size=self.batch_size)
+            if resume is not None:
+                log.warning('Streaming datasets restart from the beginning of the epoch when resuming.')
+        elif self.bucket_pool_size:
+            batch_sampler = self._batch_sampler(self.train_dataset, True)
+            if resume is not None:
+                batch_sampler.resume(resume['epoch'], resume['batches'])
+            batching = dict(batch_sampler=batch_sampler)
+        else:
+            sampler = self._sampler(self.train_dataset, True)
+            if resume is not None:
+                sampler.resume(resume['epoch'], resume['batches'] * self.batch_size)
+            batching = dict(batch_size=self.batch_size, sampler=sampler)
         return DataLoader(
             self.train_dataset,
-            batch_size=self.batch_size,
-            shuffle=True,
+            **batching,
             num_workers=self.num_workers,
             persistent_workers=self.num_workers > 0,
             pin_memory=True,
@@ -125,17 +324,27 @@ class SceneTextDataModule(pl.LightningDataModule):
         )
 
     def val_dataloader(self):
+        if self.bucket_pool_size:
+            batching = dict(batch_sampler=self._batch_sampler(self.val_dataset, False))
+        else:
+            batching = dict(batch_size=self.batch_size, sampler=self._sampler(self.val_dataset, False))
         return DataLoader(
             self.val_dataset,
-            batch_size=self.batch_size,
+            **batching,
             num_workers=self.num_workers,
             persistent_workers=self.num_workers > 0,
             pin_memory=True,
             collate_fn=self.collate_fn,
         )
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.batch_augment is not None and self.trainer is not None and self.trainer.training:
+            images, labels = batch
+            batch = self.batch_augment(images), labels
+        return batch
+
     def test_dataloaders(self, subset):
-        transform = self.get_transform(self.img_size, rotation=self.rotation)
+        transform = self.get_transform(self.img_size, rotation=self.rotation, uint8=self.uint8_images)
         root = PurePath(self.root_dir, 'test')
         datasets = {
             s: LmdbDataset(
@@ -146,9 +355,14 @@ class SceneTextDataModule(pl.LightningDataModule):
                 self.remove_whitespace,
                 self.normalize_unicode,
                 transform=transform,
+                label_cache=self.label_cache,
+                decode_threads=self.decode_threads,
             )
             for s in subset
         }
+        if self.image_cache:
+            for dataset in datasets.values():
+                self._cache_images(dataset, self.rotation)
         return {
             k: DataLoader(
                 v, batch_size=self.batch_size, num_workers=self.num_workers, pin_memory=True, collate_fn=self.collate_fn
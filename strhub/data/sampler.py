@@ -0,0 +1,192 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+from itertools import islice
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+
+import torch
+from torch.utils.data import BatchSampler, ConcatDataset, DistributedSampler, Sampler
+
+
+def _random_seed() -> int:
+    return int(torch.empty((), dtype=torch.int64).random_().item())
+
+
+class BucketBatchSampler(BatchSampler):
+    """Groups samples of similar label length into the same batch to minimize padding.
+
+    Indices are drawn from `sampler` in pools of `pool_size` batches. Each pool is sorted by label length and split into
+    batches, whose order is then shuffled (if `shuffle`). Since the pools come from `sampler`, its randomness and
+    sharding (e.g. DistributedSampler, which Lightning injects under DDP) are preserved.
+    """
+
+    def __init__(
+        self,
+        sampler: Sampler[int],
+        batch_size: int,
+        drop_last: bool,
+        lengths: Sequence[int],
+        pool_size: int = 50,
+        shuffle: bool = True,
+        seed: Optional[int] = None,
+    ) -> None:
+        super().__init__(sampler, batch_size, drop_last)
+        self.lengths = np.asarray(lengths)
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.seed = _random_seed() if seed is None else seed
+        self.epoch = 0
+        self._resume_epoch = None
+        self._resume_batches = 0
+
+    def resume(self, epoch: int, batches: int) -> None:
+        """Skip the first `batches` batches of `epoch` (once), e.g. when resuming training mid-epoch.
+
+        The inner sampler should be deterministic for the skipped batches to be the ones already consumed.
+        """
+        self._resume_epoch = epoch
+        self._resume_batches = batches
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def _split_pool(self, pool: list[int], rng: np.random.Generator) -> list[list[int]]:
+        pool = np.asarray(pool)
+        pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+        batches = [pool[i : i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size)]
+        # Only the last pool can have an incomplete batch
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self) -> Iterator[list[int]]:
+        skip = 0
+        if self._resume_epoch == self.epoch:
+            skip = self._resume_batches
+            self._resume_epoch = None
+        return islice(self._batches(), skip, None)
+
+    def _batches(self) -> Iterator[list[int]]:
+        rng = np.random.default_rng((self.seed, self.epoch))
+        pool_len = self.pool_size * self.batch_size
+        pool = []
+        for idx in self.sampler:
+            pool.append(idx)
+            if len(pool) == pool_len:
+                yield from self._split_pool(pool, rng)
+                pool = []
+        if pool:
+            yield from self._split_pool(pool, rng)
+
+
+class ResumableSampler(DistributedSampler):
+    """DistributedSampler which can skip the beginning of an epoch, to resume training mid-epoch.
+
+    The order of the samples only depends on (seed, epoch), so skipping the samples consumed before the interruption
+    continues the epoch exactly where it stopped. Also works without DDP (num_replicas=1, rank=0).
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._resume_epoch = None
+        self._resume_samples = 0
+
+    def resume(self, epoch: int, samples: int) -> None:
+        """Skip the first `samples` samples of `epoch` (once)."""
+        self._resume_epoch = epoch
+        self._resume_samples = samples
+
+    def _skip(self) -> int:
+        if self._resume_epoch != self.epoch:
+            return 0
+        self._resume_epoch = None
+        return self._resume_samples
+
+    def __iter__(self) -> Iterator[int]:
+        return islice(super().__iter__(), self._skip(), None)
+
+
+def _alias_table(probs: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Build the tables of Walker's alias method (Vose's variant) for O(1) sampling from a discrete distribution."""
+    n = len(probs)
+    scaled = np.asarray(probs, dtype=np.float64) * n
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1]
+    large = [i for i in range(n) if scaled[i] >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1 - scaled[s]
+        (small if scaled[l] < 1 else large).append(l)
+    # Whatever is left has a probability of 1 (up to rounding errors)
+    return prob, alias
+
+
+class MixtureSampler(ResumableSampler):
+    """Samples from the sub-datasets of a ConcatDataset according to the given weights.
+
+    Every draw picks a sub-dataset using the alias method, then a sample uniformly within it, both in O(1). Samples are
+    drawn with replacement, `epoch_samples` (default: size of the dataset) in total per epoch, split evenly across
+    ranks. The draws only depend on (seed, epoch, rank), so an epoch can be replayed exactly.
+
+    It is a DistributedSampler, so Lightning uses it as is instead of wrapping it for DDP.
+    """
+
+    _CHUNK = 1 << 16
+
+    def __init__(
+        self,
+        dataset: ConcatDataset,
+        weights: Sequence[float],
+        epoch_samples: Optional[int] = None,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+    ) -> None:
+        super().__init__(dataset, num_replicas, rank, shuffle=True, seed=seed)
+        sizes = np.diff(dataset.cumulative_sizes, prepend=0)
+        if len(weights) != len(sizes):
+            raise ValueError(f'Expected {len(sizes)} weights, got {len(weights)}')
+        weights = np.where(sizes > 0, np.asarray(weights, dtype=np.float64), 0.0)
+        if (weights < 0).any() or weights.sum() <= 0:
+            raise ValueError('Weights should be non-negative, with at least one non-empty dataset weighted')
+        self.sizes = sizes
+        self.offsets = np.asarray(dataset.cumulative_sizes) - sizes
+        self.prob, self.alias = _alias_table(weights / weights.sum())
+        self.num_samples = math.ceil((epoch_samples or len(dataset)) / num_replicas)
+        self.total_size = self.num_samples * num_replicas
+
+    def _draw(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        k = rng.integers(len(self.prob), size=n)
+        ds = np.where(rng.random(n) < self.prob[k], k, self.alias[k])
+        return self.offsets[ds] + (rng.random(n) * self.sizes[ds]).astype(np.int64)
+
+    def __iter__(self) -> Iterator[int]:
+        rng = np.random.default_rng((self.seed, self.epoch, self.rank))
+        skip = self._skip()
+        for start in range(0, self.num_samples, self._CHUNK):
+            # Skipped chunks are still drawn, to get to the same RNG state.
+            indices = self._draw(rng, min(self._CHUNK, self.num_samples - start))
+            if start + len(indices) > skip:
+                yield from indices[max(skip - start, 0) :].tolist()
@@ -0,0 +1,237 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Sequentially readable record shards, an alternative to LMDB for slow (e.g. network) storage.
+
+Each shard is a flat file of length-prefixed records: magic, then for each sample a little-endian (uint32 label length,
+uint32 image length) header followed by the UTF-8 label and the encoded image. A `shards.json` manifest in the same
+directory lists the shards and their number of samples.
+"""
+import io
+import json
+import logging
+import struct
+from pathlib import Path, PurePath
+from typing import Callable, Iterator, Optional, Union
+
+import numpy as np
+from PIL import Image
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from strhub.data.dataset import image_size, preprocess_label
+from strhub.data.utils import CharsetAdapter
+
+log = logging.getLogger(__name__)
+
+SHARD_MAGIC = b'STRSHRD1'
+MANIFEST = 'shards.json'
+_RECORD_HEADER = struct.Struct('<II')
+_READ_BUFFER = 8 << 20
+
+
+class ShardWriter:
+    """Writes samples into numbered shards of at most `samples_per_shard` samples each, plus the manifest."""
+
+    def __init__(self, output_dir: Union[PurePath, str], samples_per_shard: int = 10000) -> None:
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.samples_per_shard = samples_per_shard
+        self.shards = []
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        name = f'shard-{len(self.shards):06d}.rec'
+        self._file = open(self.output_dir / name, 'wb')
+        self._file.write(SHARD_MAGIC)
+        self.shards.append({'name': name, 'num_samples': 0})
+
+    def write(self, label: bytes, image: bytes) -> None:
+        if self._file is None or self.shards[-1]['num_samples'] == self.samples_per_shard:
+            self._next_shard()
+        self._file.write(_RECORD_HEADER.pack(len(label), len(image)))
+        self._file.write(label)
+        self._file.write(image)
+        self.shards[-1]['num_samples'] += 1
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        with open(self.output_dir / MANIFEST, 'w') as f:
+            json.dump({'shards': self.shards}, f, indent=1)
+
+
+def read_shard(path: Union[PurePath, str]) -> Iterator[tuple[bytes, bytes]]:
+    """Sequentially read the (label, image) records of a shard."""
+    with open(path, 'rb', buffering=_READ_BUFFER) as f:
+        if f.read(len(SHARD_MAGIC)) != SHARD_MAGIC:
+            raise ValueError(f'Invalid shard: {path}')
+        while header := f.read(_RECORD_HEADER.size):
+            label_len, image_len = _RECORD_HEADER.unpack(header)
+            label = f.read(label_len)
+            image = f.read(image_len)
+            if len(image) != image_len:
+                raise ValueError(f'Truncated shard: {path}')
+            yield label, image
+
+
+class ShardDataset(IterableDataset):
+    """Streaming dataset over all shards found under `root` (see tools/create_shards.py).
+
+    Shards are split across DDP ranks and DataLoader workers, so there should be at least
+    world_size x num_workers shards. The shard order is shuffled every epoch (seeded by `seed` and the epoch, so all
+    ranks and workers agree), and samples are shuffled within a buffer of `shuffle_buffer` samples. Labels are
+    filtered and transformed exactly like in LmdbDataset.
+
+    Every rank yields exactly len(self) samples per epoch, split evenly among its workers: each worker cycles over its
+    shards until it reaches its quota. This keeps the number of batches the same on all ranks, which DDP requires,
+    even if the shards have different sizes or filtering removes a different number of samples from each.
+
+    The epoch is counted by the dataset itself, once per call to __iter__(), since Lightning doesn't call set_epoch()
+    on iterable datasets. This relies on the DataLoader workers being persistent (see SceneTextDataModule), otherwise
+    each epoch would start from a fresh copy of the dataset.
+    """
+
+    def __init__(
+        self,
+        root: Union[PurePath, str],
+        charset: str,
+        max_label_len: int,
+        min_image_dim: int = 0,
+        remove_whitespace: bool = True,
+        normalize_unicode: bool = True,
+        transform: Optional[Callable] = None,
+        shuffle_buffer: int = 0,
+        seed: int = 0,
+    ):
+        root = Path(root).absolute()
+        self.shards = []
+        self.num_samples = 0
+        for manifest in sorted(root.glob(f'**/{MANIFEST}')):
+            with open(manifest) as f:
+                for shard in json.load(f)['shards']:
+                    self.shards.append(str(manifest.parent / shard['name']))
+                    self.num_samples += shard['num_samples']
+        log.info(f'dataset root:\t{root}\tnum shards: {len(self.shards)}\tnum samples: {self.num_samples}')
+        self.charset_adapter = CharsetAdapter(charset)
+        self.max_label_len = max_label_len
+        self.min_image_dim = min_image_dim
+        self.remove_whitespace = remove_whitespace
+        self.normalize_unicode = normalize_unicode
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+    @staticmethod
+    def _world() -> tuple[int, int]:
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    def __len__(self):
+        # Per rank. Enforced by __iter__(), since samples are filtered on the fly.
+        return self.num_samples // self._world()[1]
+
+    def _reader(self) -> tuple[int, int, int]:
+        """Index of this reader (rank and worker), number of readers, and number of samples it should yield."""
+        rank, world_size = self._world()
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        quota = len(self) // num_workers + int(worker_id < len(self) % num_workers)
+        return rank * num_workers + worker_id, world_size * num_workers, quota
+
+    def _assigned_shards(self, epoch: int) -> list[str]:
+        reader, total, _ = self._reader()
+        if len(self.shards) < total:
+            log.warning(f'Only {len(self.shards)} shards for {total} readers. Some shards will be read more than once.')
+        order = np.random.default_rng((self.seed, epoch)).permutation(len(self.shards))
+        assigned = order[reader::total]
+        if not len(assigned) and len(order):
+            assigned = order[reader % len(order) : reader % len(order) + 1]
+        return [self.shards[i] for i in assigned]
+
+    def _samples(self, shards: list[str]) -> Iterator[tuple[bytes, str]]:
+        for shard in shards:
+            for label, image in read_shard(shard):
+                label = preprocess_label(
+                    label.decode(),
+                    self.charset_adapter,
+                    self.max_label_len,
+                    self.remove_whitespace,
+                    self.normalize_unicode,
+                )
+                if not label:
+                    continue
+                if self.min_image_dim > 0 and min(image_size(image)) < self.min_image_dim:
+                    continue
+                yield image, label
+
+    def _cycled_samples(self, shards: list[str], quota: int, epoch: int) -> Iterator[tuple[bytes, str]]:
+        """Exactly `quota` samples, reading `shards` again (in a new order) as many times as needed."""
+        count = 0
+        cycle = 0
+        while True:
+            found = False
+            for sample in self._samples(shards):
+                if count == quota:
+                    return
+                found = True
+                yield sample
+                count += 1
+            if count == quota:
+                return
+            if not found:
+                raise ValueError(f'No valid samples in shards: {shards}')
+            cycle += 1
+            shards = [shards[i] for i in np.random.default_rng((self.seed, epoch, cycle)).permutation(len(shards))]
+
+    def _shuffled(self, samples: Iterator) -> Iterator:
+        if self.shuffle_buffer <= 1:
+            yield from samples
+            return
+        # Seeded by the per-worker seed set by the DataLoader
+        rng = np.random.default_rng(torch.initial_seed())
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.integers(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        shards = self._assigned_shards(self.epoch)
+        samples = self._cycled_samples(shards, self._reader()[2], self.epoch)
+        # Persistent workers iterate over their own copy once per epoch. Advance it so the shard order still changes.
+        self.epoch += 1
+        for image, label in self._shuffled(samples):
+            img = Image.open(io.BytesIO(image)).convert('RGB')
+            if self.transform is not None:
+                img = self.transform(img)
+            yield img, label
@@ -13,40 +13,65 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import re
 from abc import ABC, abstractmethod
-from itertools import groupby
 from typing import Optional
 
 import torch
 from torch import Tensor
-from torch.nn.utils.rnn import pad_sequence
+
+
+class _KeepOnly(dict):
+    """str.translate() table which keeps the given characters and deletes all the others."""
+
+    def __init__(self, chars: str) -> None:
+        super().__init__((ord(c), ord(c)) for c in chars)
+
+    def __missing__(self, key):
+        return None
 
 
 class CharsetAdapter:
     """Transforms labels according to the target charset."""
 
+    _SEP = '\x00'
+
     def __init__(self, target_charset) -> None:
         super().__init__()
         self.lowercase_only = target_charset == target_charset.lower()
         self.uppercase_only = target_charset == target_charset.upper()
-        self.unsupported = re.compile(f'[^{re.escape(target_charset)}]')
+        self.table = _KeepOnly(target_charset)
+        # Also keeps the separator used by batch(), so that the labels can be split back afterwards
+        self._batch_table = _KeepOnly(target_charset + self._SEP)
 
-    def __call__(self, label):
+    def _change_case(self, label):
         if self.lowercase_only:
             label = label.lower()
         elif self.uppercase_only:
             label = label.upper()
-        # Remove unsupported characters
-        label = self.unsupported.sub('', label)
         return label
 
+    def __call__(self, label):
+        # Remove unsupported characters
+        return self._change_case(label).translate(self.table)
+
+    def batch(self, labels: list[str]) -> list[str]:
+        """Same as calling the adapter on each label, but transforms all the labels at once."""
+        joined = self._SEP.join(labels)
+        # Labels containing the separator can't be split back
+        if joined.count(self._SEP) != len(labels) - 1:
+            return [self(label) for label in labels]
+        return self._change_case(joined).translate(self._batch_table).split(self._SEP)
+
 
 class BaseTokenizer(ABC):
 
     def __init__(self, charset: str, specials_first: tuple = (), specials_last: tuple = ()) -> None:
         self._itos = specials_first + tuple(charset) + specials_last
         self._stoi = {s: i for i, s in enumerate(self._itos)}
+        # Code point -> token ID (-1 if not in the charset), for encoding all labels of a batch at once
+        self._cp2id = torch.full((max(map(ord, charset), default=0) + 1,), -1, dtype=torch.long)
+        for c in charset:
+            self._cp2id[ord(c)] = self._stoi[c]
 
     def __len__(self):
         return len(self._itos)
@@ -58,13 +83,47 @@ class BaseTokenizer(ABC):
         tokens = [self._itos[i] for i in token_ids]
         return ''.join(tokens) if join else tokens
 
+    def _encode_batch(
+        self,
+        labels: list[str],
+        pad_id: int,
+        bos_id: Optional[int] = None,
+        eos_id: Optional[int] = None,
+        device: Optional[torch.device] = None,
+        pin_memory: bool = False,
+    ) -> Tensor:
+        """Map the code points of all labels through the lookup table into a single preallocated, padded buffer."""
+        lengths = torch.tensor([len(y) for y in labels], dtype=torch.long)
+        offset = int(bos_id is not None)
+        width = (int(lengths.max()) if len(labels) else 0) + offset + int(eos_id is not None)
+        batch = torch.full((len(labels), width), pad_id, dtype=torch.long, pin_memory=pin_memory)
+        total = int(lengths.sum())
+        if total:
+            cps = torch.frombuffer(bytearray(''.join(labels).encode('utf-32-le')), dtype=torch.int32).long()
+            known = cps < len(self._cp2id)
+            ids = torch.where(known, self._cp2id[cps.clamp(max=len(self._cp2id) - 1)], -1)
+            unknown = (ids < 0).nonzero()
+            if len(unknown):
+                raise KeyError(chr(cps[unknown[0, 0]].item()))
+            rows = torch.repeat_interleave(torch.arange(len(labels)), lengths)
+            starts = torch.repeat_interleave(lengths.cumsum(0) - lengths, lengths)
+            batch[rows, torch.arange(total) - starts + offset] = ids
+        if bos_id is not None:
+            batch[:, 0] = bos_id
+        if eos_id is not None:
+            batch[torch.arange(len(labels)), lengths + offset] = eos_id
+        if device is not None:
+            batch = batch.to(device, non_blocking=pin_memory)
+        return batch
+
     @abstractmethod
-    def encode(self, labels: list[str], device: Optional[torch.device] = None) -> Tensor:
+    def encode(self, labels: list[str], device: Optional[torch.device] = None, pin_memory: bool = False) -> Tensor:
         """Encode a batch of labels to a representation suitable for the model.
 
         Args:
             labels: List of labels. Each can be of arbitrary length.
             device: Create tensor on this device.
+            pin_memory: Build the batch in pinned memory, so that it is copied to `device` asynchronously.
 
         Returns:
             Batched tensor representation padded to the max label length. Shape: N, L
@@ -72,8 +131,16 @@ class BaseTokenizer(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def _filter(self, probs: Tensor, ids: Tensor) -> tuple[Tensor, list[int]]:
-        """Internal method which performs the necessary filtering prior to decoding."""
+    def _filter(self, probs: Tensor, ids: Tensor) -> tuple[Tensor, Tensor]:
+        """Internal method which selects, for the whole batch, the tokens and probabilities to keep prior to decoding.
+
+        Args:
+            probs: probabilities of the greedy predictions. Shape: N, L
+            ids: greedy predictions. Shape: N, L
+
+        Returns:
+            mask of the tokens to keep (Shape: N, L) and number of leading probabilities to keep per sample (Shape: N)
+        """
         raise NotImplementedError
 
     def decode(self, token_dists: Tensor, raw: bool = False) -> tuple[list[str], list[Tensor]]:
@@ -87,15 +154,21 @@ class BaseTokenizer(ABC):
             list of string labels (arbitrary length) and
             their corresponding sequence probabilities as a list of Tensors
         """
+        probs, ids = token_dists.max(-1)  # greedy selection
+        if raw:
+            return [self._ids2tok(x, False) for x in ids.tolist()], list(probs.unbind(0))
+        keep, num_probs = self._filter(probs, ids)
+        # Single transfer to the host: tokens kept per sample, probs kept per sample, then the kept token IDs
+        counts = keep.sum(1)
+        host = torch.cat([counts, num_probs.to(counts), ids[keep]]).tolist()
+        n = len(ids)
+        counts, num_probs, kept = host[:n], host[n : 2 * n], host[2 * n :]
         batch_tokens = []
-        batch_probs = []
-        for dist in token_dists:
-            probs, ids = dist.max(-1)  # greedy selection
-            if not raw:
-                probs, ids = self._filter(probs, ids)
-            tokens = self._ids2tok(ids, not raw)
-            batch_tokens.append(tokens)
-            batch_probs.append(probs)
+        start = 0
+        for count in counts:
+            batch_tokens.append(self._ids2tok(kept[start : start + count]))
+            start += count
+        batch_probs = [p[:k] for p, k in zip(probs, num_probs)]
         return batch_tokens, batch_probs
 
 
@@ -110,23 +183,18 @@ class Tokenizer(BaseTokenizer):
         super().__init__(charset, specials_first, specials_last)
         self.eos_id, self.bos_id, self.pad_id = [self._stoi[s] for s in specials_first + specials_last]
 
-    def encode(self, labels: list[str], device: Optional[torch.device] = None) -> Tensor:
-        batch = [
-            torch.as_tensor([self.bos_id] + self._tok2ids(y) + [self.eos_id], dtype=torch.long, device=device)
-            for y in labels
-        ]
-        return pad_sequence(batch, batch_first=True, padding_value=self.pad_id)
-
-    def _filter(self, probs: Tensor, ids: Tensor) -> tuple[Tensor, list[int]]:
-        ids = ids.tolist()
-        try:
-            eos_idx = ids.index(self.eos_id)
-        except ValueError:
-            eos_idx = len(ids)  # Nothing to truncate.
+    def encode(self, labels: list[str], device: Optional[torch.device] = None, pin_memory: bool = False) -> Tensor:
+        return self._encode_batch(labels, self.pad_id, self.bos_id, self.eos_id, device, pin_memory)
+
+    def _filter(self, probs: Tensor, ids: Tensor) -> tuple[Tensor, Tensor]:
+        length = ids.shape[1]
+        is_eos = ids == self.eos_id
+        # Index of the first EOS, or L if there is none (nothing to truncate)
+        eos_idx = torch.where(is_eos.any(1), is_eos.int().argmax(1), length)
         # Truncate after EOS
-        ids = ids[:eos_idx]
-        probs = probs[: eos_idx + 1]  # but include prob. for EOS (if it exists)
-        return probs, ids
+        keep = torch.arange(length, device=ids.device) < eos_idx.unsqueeze(1)
+        num_probs = (eos_idx + 1).clamp(max=length)  # but include prob. for EOS (if it exists)
+        return keep, num_probs
 
 
 class CTCTokenizer(BaseTokenizer):
@@ -137,14 +205,14 @@ class CTCTokenizer(BaseTokenizer):
         super().__init__(charset, specials_first=(self.BLANK,))
         self.blank_id = self._stoi[self.BLANK]
 
-    def encode(self, labels: list[str], device: Optional[torch.device] = None) -> Tensor:
+    def encode(self, labels: list[str], device: Optional[torch.device] = None, pin_memory: bool = False) -> Tensor:
         # We use a padded representation since we don't want to use CUDNN's CTC implementation
-        batch = [torch.as_tensor(self._tok2ids(y), dtype=torch.long, device=device) for y in labels]
-        return pad_sequence(batch, batch_first=True, padding_value=self.blank_id)
+        return self._encode_batch(labels, self.blank_id, device=device, pin_memory=pin_memory)
 
-    def _filter(self, probs: Tensor, ids: Tensor) -> tuple[Tensor, list[int]]:
-        # Best path decoding:
-        ids = list(zip(*groupby(ids.tolist())))[0]  # Remove duplicate tokens
-        ids = [x for x in ids if x != self.blank_id]  # Remove BLANKs
+    def _filter(self, probs: Tensor, ids: Tensor) -> tuple[Tensor, Tensor]:
+        # Best path decoding: remove duplicate tokens (keep the first of each run), then remove BLANKs
+        keep = ids != self.blank_id
+        keep[:, 1:] &= ids[:, 1:] != ids[:, :-1]
         # `probs` is just pass-through since all positions are considered part of the path
-        return probs, ids
+        num_probs = torch.full((len(ids),), ids.shape[1], device=ids.device)
+        return keep, num_probs
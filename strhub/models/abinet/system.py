@@ -140,6 +140,7 @@ class ABINet(CrossEntropySystem):
         return {'optimizer': optim, 'lr_scheduler': {'scheduler': self.scheduler, 'interval': 'step'}}
 
     def forward(self, images: Tensor, max_length: Optional[int] = None) -> Tensor:
+        images = self.preprocess(images)
         max_length = self.max_label_length if max_length is None else min(max_length, self.max_label_length)
         logits = self.model.forward(images)[0]['logits']
         return logits[:, : max_length + 1]  # truncate
@@ -179,6 +180,7 @@ class ABINet(CrossEntropySystem):
 
     def training_step(self, batch, batch_idx) -> STEP_OUTPUT:
         images, labels = batch
+        images = self.preprocess(images)
         inputs, lengths, targets = self._prepare_inputs_and_targets(labels)
         if self.lm_only:
             l_res = self.model.language(inputs, lengths)
@@ -18,8 +18,6 @@ from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import Optional
 
-from nltk import edit_distance
-
 import torch
 import torch.nn.functional as F
 from torch import Tensor
@@ -31,6 +29,7 @@ from pytorch_lightning.utilities.types import STEP_OUTPUT
 from timm.optim import create_optimizer_v2
 
 from strhub.data.utils import BaseTokenizer, CharsetAdapter, CTCTokenizer, Tokenizer
+from strhub.models.metrics import batch_metrics
 
 
 @dataclass
@@ -66,13 +65,25 @@ class BaseSystem(pl.LightningModule, ABC):
         self.warmup_pct = warmup_pct
         self.weight_decay = weight_decay
         self.outputs: EPOCH_OUTPUT = []
+        # Normalized value of each uint8 pixel value, computed exactly like ToTensor() + Normalize(0.5, 0.5) would
+        pixel_lut = torch.arange(256, dtype=torch.uint8).float().div(255).sub(0.5).div(0.5)
+        self.register_buffer('pixel_lut', pixel_lut, persistent=False)
+
+    def preprocess(self, images: Tensor) -> Tensor:
+        """Scale and normalize uint8 images (see SceneTextDataModule) with a single lookup.
+
+        Float images are assumed to be normalized already and are returned as is.
+        """
+        if images.dtype == torch.uint8:
+            images = self.pixel_lut[images.long()]
+        return images
 
     @abstractmethod
     def forward(self, images: Tensor, max_length: Optional[int] = None) -> Tensor:
         """Inference
 
         Args:
-            images: Batch of images. Shape: N, Ch, H, W
+            images: Batch of images, either uint8 or normalized. Shape: N, Ch, H, W
             max_length: Max sequence length of the output. If None, will use default.
 
         Returns:
@@ -112,11 +123,6 @@ class BaseSystem(pl.LightningModule, ABC):
     def _eval_step(self, batch, validation: bool) -> Optional[STEP_OUTPUT]:
         images, labels = batch
 
-        correct = 0
-        total = 0
-        ned = 0
-        confidence = 0
-        label_length = 0
         if validation:
             logits, loss, loss_numel = self.forward_logits_loss(images, labels)
         else:
@@ -131,15 +137,9 @@ class BaseSystem(pl.LightningModule, ABC):
 
         probs = logits.softmax(-1)
         preds, probs = self.tokenizer.decode(probs)
-        for pred, prob, gt in zip(preds, probs, labels):
-            confidence += prob.prod().item()
-            pred = self.charset_adapter(pred)
-            # Follow ICDAR 2019 definition of N.E.D.
-            ned += edit_distance(pred, gt) / max(len(pred), len(gt))
-            if pred == gt:
-                correct += 1
-            total += 1
-            label_length += len(pred)
+        preds = self.charset_adapter.batch(preds)
+        # Follow ICDAR 2019 definition of N.E.D.
+        total, correct, ned, confidence, label_length = batch_metrics(preds, labels, probs)
         return dict(output=BatchResult(total, correct, ned, confidence, label_length, loss, loss_numel))
 
     @staticmethod
@@ -47,6 +47,7 @@ class CRNN(CTCSystem):
         self.model.apply(init_weights)
 
     def forward(self, images: Tensor, max_length: Optional[int] = None) -> Tensor:
+        images = self.preprocess(images)
         return self.model.forward(images)
 
     def training_step(self, batch, batch_idx) -> STEP_OUTPUT:
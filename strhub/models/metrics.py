@@ -0,0 +1,119 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Batched evaluation metrics: accuracy, normalized edit distance, confidence and label length."""
+from typing import Sequence
+
+import numpy as np
+
+from torch import Tensor
+from torch.nn.utils.rnn import pad_sequence
+
+_WORD_BITS = 64
+
+
+def _levenshtein(a: str, b: str) -> int:
+    """Plain O(len(a) x len(b)) dynamic programming, for pairs too long for the bit-parallel version."""
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+def _code_points(strings: Sequence[str], width: int, fill: int) -> np.ndarray:
+    """Code points of the strings, padded with `fill`. Shape: N, width"""
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    out = np.full((len(strings), width), fill, dtype=np.int32)
+    cps = np.frombuffer(''.join(strings).encode('utf-32-le'), dtype=np.uint32).astype(np.int32)
+    out[np.arange(width) < lengths[:, None]] = cps
+    return out
+
+
+def _myers(patterns: Sequence[str], texts: Sequence[str]) -> np.ndarray:
+    """Bit-parallel Levenshtein distance (Myers, 1999; Hyyrö's formulation) of all pairs at once.
+
+    Each pattern must be at most 64 characters long, so that a column of the DP matrix fits in one uint64 word.
+    """
+    m = np.fromiter(map(len, patterns), dtype=np.int64, count=len(patterns))
+    n = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    max_m, max_n = int(m.max()), int(n.max())
+    one = np.uint64(1)
+    # Match masks: bit i of peq[k, j] is set if patterns[k][i] == texts[k][j]. Padding never matches.
+    a = _code_points(patterns, max_m, -1)
+    b = _code_points(texts, max_n, -2)
+    bits = np.left_shift(one, np.arange(max_m, dtype=np.uint64))
+    peq = np.bitwise_or.reduce(np.where(a[:, :, None] == b[:, None, :], bits[:, None], np.uint64(0)), axis=1)
+    high = np.left_shift(one, (np.maximum(m, 1) - 1).astype(np.uint64))
+    pv = np.full(len(m), np.iinfo(np.uint64).max, dtype=np.uint64)
+    mv = np.zeros(len(m), dtype=np.uint64)
+    score = m.copy()
+    for j in range(max_n):
+        active = j < n
+        eq = peq[:, j]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        score += active * (((ph & high) != 0).astype(np.int64) - ((mh & high) != 0).astype(np.int64))
+        # The first row of the DP matrix increases by one per column
+        ph = (ph << one) | one
+        mh = mh << one
+        pv = np.where(active, mh | ~(xv | ph), pv)
+        mv = np.where(active, ph & xv, mv)
+    # An empty pattern has no bits to track
+    return np.where(m > 0, score, n)
+
+
+def edit_distances(preds: Sequence[str], labels: Sequence[str]) -> np.ndarray:
+    """Levenshtein distance of each (pred, label) pair."""
+    # The distance is symmetric, so use the shorter string of each pair as the pattern
+    pairs = [(p, g) if len(p) <= len(g) else (g, p) for p, g in zip(preds, labels)]
+    out = np.zeros(len(pairs), dtype=np.int64)
+    fast = [i for i, (p, _) in enumerate(pairs) if len(p) <= _WORD_BITS]
+    if fast:
+        out[fast] = _myers([pairs[i][0] for i in fast], [pairs[i][1] for i in fast])
+    for i, (p, g) in enumerate(pairs):
+        if len(p) > _WORD_BITS:
+            out[i] = _levenshtein(p, g)
+    return out
+
+
+def sequence_confidence(probs: Sequence[Tensor]) -> list[float]:
+    """Product of the per-token probabilities of each sequence, with a single transfer to the host."""
+    if not probs:
+        return []
+    return pad_sequence(list(probs), batch_first=True, padding_value=1.0).prod(1).tolist()
+
+
+def batch_metrics(
+    preds: Sequence[str],
+    labels: Sequence[str],
+    probs: Sequence[Tensor],
+) -> tuple[int, int, float, float, int]:
+    """Sums of the evaluation metrics over a batch.
+
+    Returns:
+        number of samples, number of correct predictions, sum of the normalized edit distances (ICDAR 2019
+        definition), sum of the confidences and sum of the predicted label lengths
+    """
+    dist = edit_distances(preds, labels)
+    pred_len = np.fromiter(map(len, preds), dtype=np.int64, count=len(preds))
+    gt_len = np.fromiter(map(len, labels), dtype=np.int64, count=len(labels))
+    ned = dist / np.maximum(np.maximum(pred_len, gt_len), 1)
+    correct = sum(p == g for p, g in zip(preds, labels))
+    confidence = sum(sequence_confidence(probs))
+    return len(preds), correct, float(ned.sum()), confidence, int(pred_len.sum())
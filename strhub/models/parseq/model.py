@@ -46,12 +46,14 @@ class PARSeq(nn.Module):
         decode_ar: bool,
         refine_iters: int,
         dropout: float,
+        decode_compact: bool = False,
     ) -> None:
         super().__init__()
 
         self.max_label_length = max_label_length
         self.decode_ar = decode_ar
         self.refine_iters = refine_iters
+        self.decode_compact = decode_compact
 
         self.encoder = Encoder(
             img_size, patch_size, embed_dim=embed_dim, depth=enc_depth, num_heads=enc_num_heads, mlp_ratio=enc_mlp_ratio
@@ -102,6 +104,53 @@ class PARSeq(nn.Module):
         tgt_query = self.dropout(tgt_query)
         return self.decoder(tgt_query, tgt_emb, memory, tgt_query_mask, tgt_mask, tgt_padding_mask)
 
+    def decode_step(self, tgt: torch.Tensor, memory: torch.Tensor, cache: list[list], pos: int, tgt_query: Tensor):
+        """Incremental decode() for the canonical AR context: `tgt` only holds the newest token (at position `pos`).
+
+        `cache` is the decoder cache (see Decoder.init_cache()) of the previous positions, and is updated in place.
+        Like in decode(), `memory` can also be given as its projections (see Decoder.project_memory()).
+        """
+        tgt_emb = self.text_embed(tgt)
+        if pos > 0:
+            # <bos> stands for the null context, so it has no position information.
+            tgt_emb = self.pos_queries[:, pos - 1 : pos] + tgt_emb
+        tgt_emb = self.dropout(tgt_emb)
+        return self.decoder.forward_step(self.dropout(tgt_query), tgt_emb, memory, cache)
+
+    def _decode_ar_compact(self, memory: list, pos_queries: Tensor, bos_id: int, eos_id: int) -> Tensor:
+        """Greedy AR decoding which drops the sequences from the working batch as soon as they produce <eos>.
+
+        The projected memory (see Decoder.project_memory()) and the decoder cache of the finished sequences are dropped
+        too, so each step only costs as much as the number of unfinished sequences. The logits after <eos> are left
+        at zero. Like the regular AR loop at test time, decoding stops once all sequences are finished.
+        """
+        bs, num_steps = pos_queries.shape[:2]
+        active = torch.arange(bs, device=self._device)
+        tokens = torch.full((bs, 1), bos_id, dtype=torch.long, device=self._device)
+        logits = None
+        cache = self.decoder.init_cache()
+        for i in range(num_steps):
+            j = i + 1  # next token index
+            tgt_out = self.decode_step(tokens, memory, cache, i, pos_queries[: len(active), i:j])
+            p_i = self.head(tgt_out)
+            if logits is None:
+                logits = p_i.new_zeros((bs, num_steps, p_i.shape[-1]))
+            logits[active, i] = p_i[:, 0]
+            if j == num_steps:
+                break
+            tokens = p_i.argmax(-1)
+            unfinished = tokens[:, 0] != eos_id
+            if not unfinished.all():
+                if not unfinished.any():
+                    break
+                # Scatter back only the remaining sequences from now on
+                idx = unfinished.nonzero().squeeze(1)
+                active, tokens = active[idx], tokens[idx]
+                memory = [(k[idx], v[idx]) for k, v in memory]
+                for layer_cache in cache:
+                    layer_cache[:] = [t[idx] for t in layer_cache]
+        return logits[:, :j]
+
     def forward(self, tokenizer: Tokenizer, images: Tensor, max_length: Optional[int] = None) -> Tensor:
         testing = max_length is None
         max_length = self.max_label_length if max_length is None else min(max_length, self.max_label_length)
@@ -109,6 +158,8 @@ class PARSeq(nn.Module):
         # +1 for <eos> at end of sequence.
         num_steps = max_length + 1
         memory = self.encode(images)
+        # The memory is the same for all decoding steps, so project it into the cross-attention keys and values once.
+        memory_kv = self.decoder.project_memory(memory)
 
         # Query positions up to `num_steps`
         pos_queries = self.pos_queries[:, :num_steps].expand(bs, -1, -1)
@@ -116,24 +167,22 @@ class PARSeq(nn.Module):
         # Special case for the forward permutation. Faster than using `generate_attn_masks()`
         tgt_mask = query_mask = torch.triu(torch.ones((num_steps, num_steps), dtype=torch.float, device=self._device), 1) #https://github.com/baudm/parseq/issues/142
 
-        if self.decode_ar:
+        if self.decode_ar and testing and self.decode_compact:
+            logits = self._decode_ar_compact(memory_kv, pos_queries, tokenizer.bos_id, tokenizer.eos_id)
+        elif self.decode_ar:
             tgt_in = torch.full((bs, num_steps), tokenizer.pad_id, dtype=torch.long, device=self._device)
             tgt_in[:, 0] = tokenizer.bos_id
 
             logits = []
+            cache = self.decoder.init_cache()
             for i in range(num_steps):
                 j = i + 1  # next token index
                 # Efficient decoding:
-                # Input the context up to the ith token. We use only one query (at position = i) at a time.
+                # Input only the ith token, and use only one query (at position = i) at a time.
                 # This works because of the lookahead masking effect of the canonical (forward) AR context.
-                # Past tokens have no access to future tokens, hence are fixed once computed.
-                tgt_out = self.decode(
-                    tgt_in[:, :j],
-                    memory,
-                    tgt_mask[:j, :j],
-                    tgt_query=pos_queries[:, i:j],
-                    tgt_query_mask=query_mask[i:j, :j],
-                )
+                # Past tokens have no access to future tokens, hence are fixed once computed: their keys and values
+                # are cached by the decoder.
+                tgt_out = self.decode_step(tgt_in[:, i:j], memory_kv, cache, i, pos_queries[:, i:j])
                 # the next token probability is in the output's ith token position
                 p_i = self.head(tgt_out)
                 logits.append(p_i)
@@ -148,7 +197,7 @@ class PARSeq(nn.Module):
         else:
             # No prior context, so input is just <bos>. We query all positions.
             tgt_in = torch.full((bs, 1), tokenizer.bos_id, dtype=torch.long, device=self._device)
-            tgt_out = self.decode(tgt_in, memory, tgt_query=pos_queries)
+            tgt_out = self.decode(tgt_in, memory_kv, tgt_query=pos_queries)
             logits = self.head(tgt_out)
 
         if self.refine_iters:
@@ -162,7 +211,7 @@ class PARSeq(nn.Module):
                 # Mask tokens beyond the first EOS token.
                 tgt_padding_mask = (tgt_in == tokenizer.eos_id).int().cumsum(-1) > 0
                 tgt_out = self.decode(
-                    tgt_in, memory, tgt_mask, tgt_padding_mask, pos_queries, query_mask[:, : tgt_in.shape[1]]
+                    tgt_in, memory_kv, tgt_mask, tgt_padding_mask, pos_queries, query_mask[:, : tgt_in.shape[1]]
                 )
                 logits = self.head(tgt_out)
 
@@ -14,7 +14,7 @@
 # limitations under the License.
 
 import math
-from typing import Optional
+from typing import Optional, Union
 
 import torch
 from torch import Tensor, nn as nn
@@ -24,6 +24,27 @@ from torch.nn.modules import transformer
 from timm.models.vision_transformer import PatchEmbed, VisionTransformer
 
 
+def _project_kv(attn: nn.MultiheadAttention, x: Tensor) -> tuple[Tensor, Tensor]:
+    """Project `x` into the keys and values of `attn`. Shape: N, nhead, S, head_dim"""
+    e = attn.embed_dim
+    bias = None if attn.in_proj_bias is None else attn.in_proj_bias[e:]
+    kv = F.linear(x, attn.in_proj_weight[e:], bias)
+    return kv.view(*x.shape[:2], 2, attn.num_heads, attn.head_dim).permute(2, 0, 3, 1, 4).unbind(0)
+
+
+def _attend(attn: nn.MultiheadAttention, x: Tensor, k: Tensor, v: Tensor) -> Tensor:
+    """Same as attn(x, key, value)[0], given the keys and values already projected by _project_kv()."""
+    e = attn.embed_dim
+    n, l, _ = x.shape
+    bias = None if attn.in_proj_bias is None else attn.in_proj_bias[:e]
+    q = F.linear(x, attn.in_proj_weight[:e], bias).view(n, l, attn.num_heads, attn.head_dim).transpose(1, 2)
+    # Same computation as in F.multi_head_attention_forward()
+    weights = (q * math.sqrt(1.0 / float(attn.head_dim))) @ k.transpose(-2, -1)
+    weights = F.dropout(weights.softmax(-1), attn.dropout, attn.training)
+    out = (weights @ v).transpose(1, 2).reshape(n, l, e)
+    return attn.out_proj(out)
+
+
 class DecoderLayer(nn.Module):
     """A Transformer decoder layer supporting two-stream attention (XLNet)
     This implements a pre-LN decoder, as opposed to the post-LN default in PyTorch."""
@@ -52,30 +73,41 @@ class DecoderLayer(nn.Module):
             state['activation'] = F.gelu
         super().__setstate__(state)
 
+    def project_memory(self, memory: Tensor) -> tuple[Tensor, Tensor]:
+        """Keys and values of the cross-attention, which can be passed in place of `memory`."""
+        return _project_kv(self.cross_attn, memory)
+
+    def _cross_attn_ffn(self, tgt: Tensor, memory: Union[Tensor, tuple[Tensor, Tensor]]):
+        """Second half of forward_stream(): cross-attention to the memory and feedforward model."""
+        if isinstance(memory, tuple):
+            tgt2, ca_weights = _attend(self.cross_attn, self.norm1(tgt), *memory), None
+        else:
+            tgt2, ca_weights = self.cross_attn(self.norm1(tgt), memory, memory)
+        tgt = tgt + self.dropout2(tgt2)
+
+        tgt2 = self.linear2(self.dropout(self.activation(self.linear1(self.norm2(tgt)))))
+        tgt = tgt + self.dropout3(tgt2)
+        return tgt, ca_weights
+
     def forward_stream(
         self,
         tgt: Tensor,
         tgt_norm: Tensor,
         tgt_kv: Tensor,
-        memory: Tensor,
+        memory: Union[Tensor, tuple[Tensor, Tensor]],
         tgt_mask: Optional[Tensor],
         tgt_key_padding_mask: Optional[Tensor],
     ):
         """Forward pass for a single stream (i.e. content or query)
         tgt_norm is just a LayerNorm'd tgt. Added as a separate parameter for efficiency.
         Both tgt_kv and memory are expected to be LayerNorm'd too.
-        memory is LayerNorm'd by ViT.
+        memory is LayerNorm'd by ViT. It can also be given as its keys and values (see project_memory()).
         """
         tgt2, sa_weights = self.self_attn(
             tgt_norm, tgt_kv, tgt_kv, attn_mask=tgt_mask, key_padding_mask=tgt_key_padding_mask
         )
         tgt = tgt + self.dropout1(tgt2)
-
-        tgt2, ca_weights = self.cross_attn(self.norm1(tgt), memory, memory)
-        tgt = tgt + self.dropout2(tgt2)
-
-        tgt2 = self.linear2(self.dropout(self.activation(self.linear1(self.norm2(tgt)))))
-        tgt = tgt + self.dropout3(tgt2)
+        tgt, ca_weights = self._cross_attn_ffn(tgt, memory)
         return tgt, sa_weights, ca_weights
 
     def forward(
@@ -97,6 +129,26 @@ class DecoderLayer(nn.Module):
             )[0]
         return query, content
 
+    def forward_step(self, query, content, memory, cache: list, update_content: bool = True):
+        """Incremental forward pass for the canonical (left-to-right) AR context.
+
+        `content` only holds the newest position. `cache` holds the projected keys and values of the content stream
+        for the previous positions (empty at the first step), and is updated in place. Since no position attends to
+        the ones after it, the cached positions are the same as if the whole prefix was processed again.
+        """
+        content_norm = self.norm_c(content)
+        k, v = _project_kv(self.self_attn, content_norm)
+        if cache:
+            k = torch.cat([cache[0], k], dim=2)
+            v = torch.cat([cache[1], v], dim=2)
+        cache[:] = [k, v]
+        query = query + self.dropout1(_attend(self.self_attn, self.norm_q(query), k, v))
+        query = self._cross_attn_ffn(query, memory)[0]
+        if update_content:
+            content = content + self.dropout1(_attend(self.self_attn, content_norm, k, v))
+            content = self._cross_attn_ffn(content, memory)[0]
+        return query, content
+
 
 class Decoder(nn.Module):
     __constants__ = ['norm']
@@ -119,7 +171,39 @@ class Decoder(nn.Module):
         for i, mod in enumerate(self.layers):
             last = i == len(self.layers) - 1
             query, content = mod(
-                query, content, memory, query_mask, content_mask, content_key_padding_mask, update_content=not last
+                query,
+                content,
+                self._layer_memory(memory, i),
+                query_mask,
+                content_mask,
+                content_key_padding_mask,
+                update_content=not last,
+            )
+        query = self.norm(query)
+        return query
+
+    def project_memory(self, memory: Tensor) -> list[tuple[Tensor, Tensor]]:
+        """Per-layer cross-attention keys and values of the memory.
+
+        The result can be passed in place of `memory` to forward() and forward_step(), so that the memory is projected
+        only once when decoding repeatedly (AR decoding, refinement).
+        """
+        return [mod.project_memory(memory) for mod in self.layers]
+
+    @staticmethod
+    def _layer_memory(memory, i: int):
+        return memory[i] if isinstance(memory, list) else memory
+
+    def init_cache(self) -> list[list]:
+        """Empty per-layer cache for forward_step()"""
+        return [[] for _ in self.layers]
+
+    def forward_step(self, query, content, memory, cache: list[list]):
+        """Incremental forward() for the newest position only (see DecoderLayer.forward_step())"""
+        for i, mod in enumerate(self.layers):
+            last = i == len(self.layers) - 1
+            query, content = mod.forward_step(
+                query, content, self._layer_memory(memory, i), cache[i], update_content=not last
             )
         query = self.norm(query)
         return query
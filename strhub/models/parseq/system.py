@@ -33,7 +33,7 @@ from strhub.models.base import CrossEntropySystem
 #sys.path.append(previous_path)
 
 from strhub.models.utils import init_weights
-from .modules import DecoderLayer, Decoder, Encoder, TokenEmbedding, EncoderEffFormer
+from .modules import DecoderLayer, Decoder, Encoder, TokenEmbedding
 
 
 class PARSeq(CrossEntropySystem):
@@ -44,13 +44,15 @@ class PARSeq(CrossEntropySystem):
                  enc_num_heads: int, enc_mlp_ratio: int, enc_depth: int,
                  dec_num_heads: int, dec_mlp_ratio: int, dec_depth: int,
                  perm_num: int, perm_forward: bool, perm_mirrored: bool,
-                 decode_ar: bool, refine_iters: int, dropout: float, **kwargs: Any) -> None:
+                 decode_ar: bool, refine_iters: int, dropout: float, decode_compact: bool = False,
+                 perm_fold: bool = False, perm_chunk_size: int = 0, **kwargs: Any) -> None:
         super().__init__(charset_train, charset_test, batch_size, lr, warmup_pct, weight_decay)
         self.save_hyperparameters()
 
         self.max_label_length = max_label_length
         self.decode_ar = decode_ar
         self.refine_iters = refine_iters
+        self.decode_compact = decode_compact
 
         # print('Image size for encoder: ', img_size)
         # self.encoder = EncoderEffFormer(img_size, patch_size=patch_size, embed_dim=embed_dim, depth=enc_depth, num_heads=enc_num_heads,
@@ -69,6 +71,10 @@ class PARSeq(CrossEntropySystem):
         self.max_gen_perms = perm_num // 2 if perm_mirrored else perm_num
         self.perm_forward = perm_forward
         self.perm_mirrored = perm_mirrored
+        self.perm_fold = perm_fold
+        self.perm_chunk_size = perm_chunk_size
+        # Refinement masks per (num_steps, device), see _refine_mask()
+        self._refine_masks = {}
 
         # We don't predict <bos> nor <pad>
         self.head = nn.Linear(embed_dim, len(self.tokenizer) - 2)
@@ -106,41 +112,102 @@ class PARSeq(CrossEntropySystem):
         tgt_query = self.dropout(tgt_query)
         return self.decoder(tgt_query, tgt_emb, memory, tgt_query_mask, tgt_mask, tgt_padding_mask)
 
+    def decode_step(self, tgt: torch.Tensor, memory: torch.Tensor, cache: list[list], pos: int, tgt_query: Tensor):
+        """Incremental decode() for the canonical AR context: `tgt` only holds the newest token (at position `pos`).
+
+        `cache` is the decoder cache (see Decoder.init_cache()) of the previous positions, and is updated in place.
+        Like in decode(), `memory` can also be given as its projections (see Decoder.project_memory()).
+        """
+        tgt_emb = self.text_embed(tgt)
+        if pos > 0:
+            # <bos> stands for the null context, so it has no position information.
+            tgt_emb = self.pos_queries[:, pos - 1:pos] + tgt_emb
+        tgt_emb = self.dropout(tgt_emb)
+        return self.decoder.forward_step(self.dropout(tgt_query), tgt_emb, memory, cache)
+
+    def _decode_ar_compact(self, memory: list, pos_queries: Tensor, bos_id: int, eos_id: int) -> Tensor:
+        """Greedy AR decoding which drops the sequences from the working batch as soon as they produce <eos>.
+
+        The projected memory (see Decoder.project_memory()) and the decoder cache of the finished sequences are dropped
+        too, so each step only costs as much as the number of unfinished sequences. The logits after <eos> are left
+        at zero. Like the regular AR loop at test time, decoding stops once all sequences are finished.
+        """
+        bs, num_steps = pos_queries.shape[:2]
+        active = torch.arange(bs, device=self._device)
+        tokens = torch.full((bs, 1), bos_id, dtype=torch.long, device=self._device)
+        logits = None
+        cache = self.decoder.init_cache()
+        for i in range(num_steps):
+            j = i + 1  # next token index
+            tgt_out = self.decode_step(tokens, memory, cache, i, pos_queries[:len(active), i:j])
+            p_i = self.head(tgt_out)
+            if logits is None:
+                logits = p_i.new_zeros((bs, num_steps, p_i.shape[-1]))
+            logits[active, i] = p_i[:, 0]
+            if j == num_steps:
+                break
+            tokens = p_i.argmax(-1)
+            unfinished = tokens[:, 0] != eos_id
+            if not unfinished.all():
+                if not unfinished.any():
+                    break
+                # Scatter back only the remaining sequences from now on
+                idx = unfinished.nonzero().squeeze(1)
+                active, tokens = active[idx], tokens[idx]
+                memory = [(k[idx], v[idx]) for k, v in memory]
+                for layer_cache in cache:
+                    layer_cache[:] = [t[idx] for t in layer_cache]
+        return logits[:, :j]
+
+    def _refine_mask(self, num_steps: int) -> Tensor:
+        """Cached 'cloze' attention mask used for iterative refinement. Must not be modified in place."""
+        key = (num_steps, self._device)
+        mask = self._refine_masks.get(key)
+        if mask is None:
+            # Not an inference tensor, even if first created during validation, so it can be reused with autograd on.
+            with torch.inference_mode(False):
+                # We can derive it from the AR forward mask by unmasking the token context to the right.
+                mask = torch.full((num_steps, num_steps), float('-inf'), device=self._device).triu_(1)
+                mask.masked_fill_(torch.ones_like(mask, dtype=torch.bool).triu_(2), 0)
+            self._refine_masks[key] = mask
+        return mask
+
     def forward(self, images: Tensor, max_length: Optional[int] = None) -> Tensor:
+        images = self.preprocess(images)
         testing = max_length is None
         max_length = self.max_label_length if max_length is None else min(max_length, self.max_label_length)
         bs = images.shape[0]
         # +1 for <eos> at end of sequence.
         num_steps = max_length + 1
         memory = self.encode(images)
+        # The memory is the same for all decoding steps, so project it into the cross-attention keys and values once.
+        memory_kv = self.decoder.project_memory(memory)
 
         # Query positions up to `num_steps`
         pos_queries = self.pos_queries[:, :num_steps].expand(bs, -1, -1)
 
-        # Special case for the forward permutation. Faster than using `generate_attn_masks()`
-        tgt_mask = query_mask = torch.from_numpy(np.triu(torch.full((num_steps, num_steps), float('-inf'), device=self._device).numpy(), 1))
-
-
-        if self.decode_ar:
+        if self.decode_ar and testing and self.decode_compact:
+            logits = self._decode_ar_compact(memory_kv, pos_queries, self.bos_id, self.eos_id)
+        elif self.decode_ar:
             tgt_in = torch.full((bs, num_steps), self.pad_id, dtype=torch.long, device=self._device)
             tgt_in[:, 0] = self.bos_id
 
             logits = []
+            cache = self.decoder.init_cache()
             for i in range(num_steps):
                 j = i + 1  # next token index
                 # Efficient decoding:
-                # Input the context up to the ith token. We use only one query (at position = i) at a time.
+                # Input only the ith token, and use only one query (at position = i) at a time.
                 # This works because of the lookahead masking effect of the canonical (forward) AR context.
-                # Past tokens have no access to future tokens, hence are fixed once computed.
-                tgt_out = self.decode(tgt_in[:, :j], memory, tgt_mask[:j, :j], tgt_query=pos_queries[:, i:j],
-                                      tgt_query_mask=query_mask[i:j, :j])
+                # Past tokens have no access to future tokens, hence are fixed once computed: their keys and values
+                # are cached by the decoder.
+                tgt_out = self.decode_step(tgt_in[:, i:j], memory_kv, cache, i, pos_queries[:, i:j])
                 # the next token probability is in the output's ith token position
                 p_i = self.head(tgt_out)
                 logits.append(p_i)
                 if j < num_steps:
                     # greedy decode. add the next token index to the target input
-                    for one_array in tgt_in:
-                        one_array[j] = p_i.squeeze().argmax(-1)
+                    tgt_in[:, j] = p_i.squeeze(1).argmax(-1)
                     # Efficient batch decoding: If all output words have at least one EOS token, end decoding.
                     if testing and (tgt_in == self.eos_id).any(dim=-1).all():
                         break
@@ -149,36 +216,23 @@ class PARSeq(CrossEntropySystem):
         else:
             # No prior context, so input is just <bos>. We query all positions.
             tgt_in = torch.full((bs, 1), self.bos_id, dtype=torch.long, device=self._device)
-            tgt_out = self.decode(tgt_in, memory, tgt_query=pos_queries)
+            tgt_out = self.decode(tgt_in, memory_kv, tgt_query=pos_queries)
             logits = self.head(tgt_out)
 
         if self.refine_iters:
-            # For iterative refinement, we always use a 'cloze' mask.
-            # We can derive it from the AR forward mask by unmasking the token context to the right.
-            query_mask[torch.from_numpy(np.triu(torch.ones(num_steps, num_steps, dtype=torch.bool, device=self._device).numpy(), 2))] = 0
+            # For iterative refinement, we always use a 'cloze' mask, for both the content and query streams.
+            refine_mask = self._refine_mask(num_steps)
             bos = torch.full((bs, 1), self.bos_id, dtype=torch.long, device=self._device)
             for i in range(self.refine_iters):
                 # Prior context is the previous output.
                 tgt_in = torch.cat([bos, logits[:, :-1].argmax(-1)], dim=1)
-                #################################
-                bool_array = (tgt_in == self.eos_id)
-                final_custom_cumsum = []
-                cumsum_custom = []
-                for cumsum_one_array in bool_array:
-                    sum =0
-                    for cumsum_element in cumsum_one_array:
-                        sum = sum + cumsum_element
-                        cumsum_custom.append(int(sum))
-                    final_custom_cumsum.append(cumsum_custom)
-                final_custom_cumsum = torch.from_numpy(np.array(final_custom_cumsum))
-                tgt_padding_mask = (final_custom_cumsum > 0)
-                #################################
-                
-                tgt_out = self.decode(tgt_in, memory, tgt_mask, tgt_padding_mask,
-                                      tgt_query=pos_queries, tgt_query_mask=query_mask[:, :tgt_in.shape[1]])
+                L = tgt_in.shape[1]
+                # Mask tokens beyond the first EOS token.
+                tgt_padding_mask = (tgt_in == self.eos_id).int().cumsum(-1) > 0
+                tgt_out = self.decode(tgt_in, memory_kv, refine_mask[:L, :L], tgt_padding_mask,
+                                      tgt_query=pos_queries, tgt_query_mask=refine_mask[:, :L])
                 logits = self.head(tgt_out)
 
-
         return logits
 
     def gen_tgt_perms(self, tgt):
@@ -241,22 +295,80 @@ class PARSeq(CrossEntropySystem):
 
     def generate_attn_masks(self, perm):
         """Generate attention masks given a sequence permutation (includes pos. for bos and eos tokens)
-        :param perm: the permutation sequence. i = 0 is always the BOS
+        :param perm: the permutation sequence. i = 0 is always the BOS. Can also be a batch of permutations (P, T)
         :return: lookahead attention masks
         """
-        sz = perm.shape[0]
-        mask = torch.zeros((sz, sz), device=self._device)
-        for i in range(sz):
-            query_idx = perm[i]
-            masked_keys = perm[i + 1:]
-            mask[query_idx, masked_keys] = float('-inf')
-        content_mask = mask[:-1, :-1].clone()
-        mask[torch.eye(sz, dtype=torch.bool, device=self._device)] = float('-inf')  # mask "self"
-        query_mask = mask[1:, :-1]
+        sz = perm.shape[-1]
+        # Position of each token within the permutation. A query can't attend to the keys which come after it.
+        order = torch.empty_like(perm).scatter_(-1, perm, torch.arange(sz, device=perm.device).expand_as(perm))
+        masked = order.unsqueeze(-1) < order.unsqueeze(-2)
+        mask = torch.zeros(masked.shape, device=self._device).masked_fill_(masked, float('-inf'))
+        content_mask = mask[..., :-1, :-1].clone()
+        mask.diagonal(dim1=-2, dim2=-1).fill_(float('-inf'))  # mask "self"
+        query_mask = mask[..., 1:, :-1]
         return content_mask, query_mask
 
+    def _folded_perm_loss(self, perms, start, tgt_in, tgt_out, memory, tgt_padding_mask):
+        """Summed loss of the permutations, from a single decoder pass over the batch repeated once per permutation.
+
+        Same as the per-permutation loop in training_step(), with per-sample attention masks instead.
+        `start` is the index of the first of `perms` among all the permutations of the batch.
+        """
+        num_perms, bs = len(perms), len(tgt_in)
+        content_mask, query_mask = self.generate_attn_masks(perms)
+
+        def expand(mask):
+            # (P, L, S) -> (P * N * nhead, L, S), the layout expected by nn.MultiheadAttention for per-sample masks
+            return mask.unsqueeze(1).expand(-1, bs * self.hparams.dec_num_heads, -1, -1).flatten(end_dim=1)
+
+        # Project the memory once, then share it across the permutations
+        memory = [(k.repeat(num_perms, 1, 1, 1), v.repeat(num_perms, 1, 1, 1))
+                  for k, v in self.decoder.project_memory(memory)]
+        out = self.decode(tgt_in.repeat(num_perms, 1), memory, expand(content_mask),
+                          tgt_padding_mask.repeat(num_perms, 1), tgt_query_mask=expand(query_mask))
+        tgt_out = tgt_out.repeat(num_perms, 1)
+        # Done with canonical and reverse orderings, remove the [EOS] tokens for the succeeding perms
+        i = max(2 - start, 0) * bs
+        tgt_out[i:] = torch.where(tgt_out[i:] == self.eos_id, self.pad_id, tgt_out[i:])
+        logits = self.head(out).flatten(end_dim=1)
+        return F.cross_entropy(logits, tgt_out.flatten(), ignore_index=self.pad_id, reduction='sum')
+
+    def _perm_loss_numel(self, perms, tgt_out):
+        """Number of targets over all permutations. [EOS] tokens are only targets for the first two permutations."""
+        n = (tgt_out != self.pad_id).sum()
+        n_eos = (tgt_out == self.eos_id).sum()
+        return len(perms) * n - max(len(perms) - 2, 0) * n_eos
+
+    def _chunked_perm_loss(self, perms, tgt_in, tgt_out, memory, tgt_padding_mask):
+        """Loss of all permutations, with the decoder backward pass done per chunk of `perm_chunk_size` permutations.
+
+        The decoder runs on a detached `memory`, so the graph of each chunk is freed right after its gradients
+        are computed, and peak memory is bounded by a single chunk. The returned loss has the value of the full loss,
+        but its gradients come from the accumulated ones (the encoder ones flow through `memory`), so the regular
+        backward pass (AMP scaling, gradient accumulation) still applies to all parameters.
+        """
+        loss_numel = self._perm_loss_numel(perms, tgt_out).item()
+        # Compute the gradients at the same scale as the final backward pass, so that they don't underflow with fp16.
+        scaler = getattr(self.trainer.precision_plugin, 'scaler', None)
+        scale = scaler.get_scale() if scaler is not None else 1.0
+        memory_leaf = memory.detach().requires_grad_()
+        params = [p for name, p in self.named_parameters() if p.requires_grad and not name.startswith('encoder.')]
+        inputs = [memory_leaf] + params
+        grads = [None] * len(inputs)
+        loss = 0
+        for start in range(0, len(perms), self.perm_chunk_size):
+            chunk = perms[start:start + self.perm_chunk_size]
+            chunk_loss = self._folded_perm_loss(chunk, start, tgt_in, tgt_out, memory_leaf, tgt_padding_mask)
+            chunk_grads = torch.autograd.grad(chunk_loss * (scale / loss_numel), inputs, allow_unused=True)
+            grads = [a if b is None else b if a is None else a + b for a, b in zip(grads, chunk_grads)]
+            loss += chunk_loss.detach()
+        surrogate = sum((t * (g / scale)).sum() for t, g in zip([memory] + params, grads) if g is not None)
+        loss = loss / loss_numel
+        return surrogate + (loss - surrogate).detach()
+
     def training_step(self, batch, batch_idx) -> STEP_OUTPUT:
         images, labels = batch
+        images = self.preprocess(images)
         tgt = self.tokenizer.encode(labels, self._device)
 
         # Encode the source sequence (i.e. the image codes)
@@ -269,6 +381,16 @@ class PARSeq(CrossEntropySystem):
         # The [EOS] token is not depended upon by any other token in any permutation ordering
         tgt_padding_mask = (tgt_in == self.pad_id) | (tgt_in == self.eos_id)
 
+        if self.perm_chunk_size > 0:
+            loss = self._chunked_perm_loss(tgt_perms, tgt_in, tgt_out, memory, tgt_padding_mask)
+            self.log('loss', loss)
+            return loss
+        if self.perm_fold:
+            loss = self._folded_perm_loss(tgt_perms, 0, tgt_in, tgt_out, memory, tgt_padding_mask)
+            loss = loss / self._perm_loss_numel(tgt_perms, tgt_out)
+            self.log('loss', loss)
+            return loss
+
         loss = 0
         loss_numel = 0
         n = (tgt_out != self.pad_id).sum().item()
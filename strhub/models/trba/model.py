@@ -33,7 +33,7 @@ class TRBA(nn.Module):
         else:
             self.Prediction = Attention(self.SequenceModeling_output, hidden_size, num_class)
 
-    def forward(self, image, max_label_length, text=None):
+    def forward(self, image, max_label_length, text=None, eos_id=None):
         """ Transformation stage """
         image = self.Transformation(image)
 
@@ -48,7 +48,7 @@ class TRBA(nn.Module):
 
         """ Prediction stage """
         if isinstance(self.Prediction, Attention):
-            prediction = self.Prediction(contextual_feature.contiguous(), text, max_label_length)
+            prediction = self.Prediction(contextual_feature.contiguous(), text, max_label_length, eos_id)
         else:
             prediction = self.Prediction(contextual_feature.contiguous())  # CTC
 
@@ -13,11 +13,13 @@ class Attention(nn.Module):
         self.generator = nn.Linear(hidden_size, num_class)
         self.char_embeddings = nn.Embedding(num_class, num_char_embeddings)
 
-    def forward(self, batch_H, text, max_label_length=25):
+    def forward(self, batch_H, text, max_label_length=25, eos_id=None):
         """
         input:
             batch_H : contextual_feature H = hidden state of encoder. [batch_size x num_steps x num_class]
             text : the text-index of each image. [batch_size x (max_length+1)]. +1 for [SOS] token. text[:, 0] = [SOS].
+            eos_id : (eval only) if given, drop the sequences from the working batch once they predict [EOS], and stop
+                when all of them did. The outputs after [EOS] are left at zero.
         output: probability distribution at each step [batch_size x num_steps x num_class]
         """
         batch_size = batch_H.size(0)
@@ -39,13 +41,23 @@ class Attention(nn.Module):
             targets = text[0].expand(batch_size)  # should be fill with [SOS] token
             probs = batch_H.new_zeros((batch_size, num_steps, self.num_class), dtype=torch.float)
 
+            active = torch.arange(batch_size, device=batch_H.device)
             for i in range(num_steps):
                 char_embeddings = self.char_embeddings(targets)
                 hidden, alpha = self.attention_cell(hidden, batch_H, char_embeddings)
                 probs_step = self.generator(hidden[0])
-                probs[:, i, :] = probs_step
+                probs[active, i, :] = probs_step
                 _, next_input = probs_step.max(1)
                 targets = next_input
+                if eos_id is not None:
+                    unfinished = targets != eos_id
+                    if not unfinished.all():
+                        if not unfinished.any():
+                            break
+                        # Keep decoding only the remaining sequences
+                        idx = unfinished.nonzero().squeeze(1)
+                        active, targets, batch_H = active[idx], targets[idx], batch_H[idx]
+                        hidden = (hidden[0][idx], hidden[1][idx])
 
         return probs  # batch_size x num_steps x num_class
 
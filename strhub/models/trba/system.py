@@ -44,11 +44,13 @@ class TRBA(CrossEntropySystem):
         num_fiducial: int,
         output_channel: int,
         hidden_size: int,
+        decode_compact: bool = False,
         **kwargs: Any,
     ) -> None:
         super().__init__(charset_train, charset_test, batch_size, lr, warmup_pct, weight_decay)
         self.save_hyperparameters()
         self.max_label_length = max_label_length
+        self.decode_compact = decode_compact
         img_h, img_w = img_size
         self.model = Model(
             img_h,
@@ -66,12 +68,17 @@ class TRBA(CrossEntropySystem):
         return {'model.Prediction.char_embeddings.weight'}
 
     def forward(self, images: Tensor, max_length: Optional[int] = None) -> Tensor:
+        images = self.preprocess(images)
+        testing = max_length is None
         max_length = self.max_label_length if max_length is None else min(max_length, self.max_label_length)
         text = images.new_full([1], self.bos_id, dtype=torch.long)
-        return self.model.forward(images, max_length, text)
+        # Only at test time, since the loss (validation) needs the logits after <eos> too.
+        eos_id = self.eos_id if testing and self.decode_compact else None
+        return self.model.forward(images, max_length, text, eos_id)
 
     def training_step(self, batch, batch_idx) -> STEP_OUTPUT:
         images, labels = batch
+        images = self.preprocess(images)
         encoded = self.tokenizer.encode(labels, self.device)
         inputs = encoded[:, :-1]  # remove <eos>
         targets = encoded[:, 1:]  # remove <bos>
@@ -116,6 +123,7 @@ class TRBC(CTCSystem):
 
     def forward(self, images: Tensor, max_length: Optional[int] = None) -> Tensor:
         # max_label_length is unused in CTC prediction
+        images = self.preprocess(images)
         return self.model.forward(images, None)
 
     def training_step(self, batch, batch_idx) -> STEP_OUTPUT:
@@ -65,6 +65,7 @@ class ViTSTR(CrossEntropySystem):
         return {'model.' + n for n in self.model.no_weight_decay()}
 
     def forward(self, images: Tensor, max_length: Optional[int] = None) -> Tensor:
+        images = self.preprocess(images)
         max_length = self.max_label_length if max_length is None else min(max_length, self.max_label_length)
         logits = self.model.forward(images, max_length + 2)  # +2 tokens for [GO] and [s]
         # Truncate to conform to other models. [GO] in ViTSTR is actually used as the padding (therefore, ignored).
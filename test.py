@@ -73,12 +73,18 @@ def main():
     parser.add_argument('--data_root', default='data')
     parser.add_argument('--batch_size', type=int, default=512)
     parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument(
+        '--decode_threads', type=int, default=0, help='Decode the images of each batch using a pool of N threads'
+    )
     parser.add_argument('--cased', action='store_true', default=False, help='Cased comparison')
     parser.add_argument('--punctuation', action='store_true', default=False, help='Check punctuation')
     parser.add_argument('--digits', action='store_true', default=False, help='Only digits')
     parser.add_argument('--new', action='store_true', default=False, help='Evaluate on new benchmark datasets')
     parser.add_argument('--rotation', type=int, default=0, help='Angle of rotation (counter clockwise) in degrees.')
     parser.add_argument('--device', default='cuda')
+    parser.add_argument(
+        '--image_cache', action='store_true', default=False, help='Cache decoded and resized images next to each LMDB'
+    )
     args, unknown = parser.parse_known_args()
     kwargs = parse_model_args(unknown)
 
@@ -105,6 +111,9 @@ def main():
         args.num_workers,
         False,
         rotation=args.rotation,
+        image_cache=args.image_cache,
+        uint8_images=True,
+        decode_threads=args.decode_threads,
     )
 
     test_set = SceneTextDataModule.TEST_BENCHMARK_SUB + SceneTextDataModule.TEST_BENCHMARK
@@ -36,6 +36,7 @@ def createDataset(inputPath, gtFile, outputPath, checkValid=True):
 
     cache = {}
     cnt = 1
+    sizes = []  # (width, height) of each sample, used to filter by image size without decoding
 
     with open(gtFile, 'r', encoding='utf-8') as f:
         data = f.readlines()
@@ -56,6 +57,13 @@ def createDataset(inputPath, gtFile, outputPath, checkValid=True):
             if np.prod(img.size) == 0:
                 print('%s is not a valid image' % imagePath)
                 continue
+            sizes.append(img.size)
+        else:
+            try:
+                sizes.append(Image.open(io.BytesIO(imageBin)).size)  # only reads the header
+            except Exception:
+                # Unchecked images are written as is. (0, 0) makes readers filter them out if min_image_dim > 0.
+                sizes.append((0, 0))
 
         imageKey = 'image-%09d'.encode() % cnt
         labelKey = 'label-%09d'.encode() % cnt
@@ -69,6 +77,7 @@ def createDataset(inputPath, gtFile, outputPath, checkValid=True):
         cnt += 1
     nSamples = cnt - 1
     cache['num-samples'.encode()] = str(nSamples).encode()
+    cache['size-index'.encode()] = np.asarray(sizes, dtype='<u4').reshape(-1, 2).tobytes()
     writeCache(env, cache)
     env.close()
     print('Created dataset with %d samples' % nSamples)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Convert LMDB datasets into sequentially readable record shards (see strhub/data/shards.py)."""
+import glob
+import os
+import sys
+from argparse import ArgumentParser
+
+import lmdb
+import numpy as np
+
+sys.path.insert(0, '.')
+from strhub.data.shards import ShardWriter
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('inputs', nargs='+', help='Path to input LMDBs (or directories containing LMDBs)')
+    parser.add_argument('--output', required=True, help='Output directory for the shards')
+    parser.add_argument('--samples_per_shard', type=int, default=10000)
+    parser.add_argument('--shuffle', action='store_true', default=False, help='Shuffle the samples across shards')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    roots = []
+    for path in args.inputs:
+        roots.extend(sorted(os.path.dirname(p) for p in glob.glob(os.path.join(path, '**/data.mdb'), recursive=True)))
+    if not roots:
+        print('Error: No LMDBs found.')
+        return
+
+    envs = [lmdb.open(root, readonly=True, max_readers=1, lock=False, readahead=False, meminit=False) for root in roots]
+    samples = []  # (env index, sample index)
+    for i, env in enumerate(envs):
+        with env.begin() as txn:
+            num_samples = int(txn.get('num-samples'.encode()))
+        print(f'{roots[i]}: {num_samples} samples')
+        samples.append(np.stack([np.full(num_samples, i), np.arange(1, num_samples + 1)], axis=1))
+    samples = np.concatenate(samples)
+    if args.shuffle:
+        samples = samples[np.random.default_rng(args.seed).permutation(len(samples))]
+
+    with ShardWriter(args.output, args.samples_per_shard) as writer:
+        txns = [env.begin() for env in envs]
+        for n, (i, index) in enumerate(samples.tolist(), 1):
+            label = txns[i].get(f'label-{index:09d}'.encode())
+            image = txns[i].get(f'image-{index:09d}'.encode())
+            writer.write(label, image)
+            if n % 10000 == 0:
+                print(f'Written {n} / {len(samples)}')
+        for txn in txns:
+            txn.abort()
+    for env in envs:
+        env.close()
+    print(f'Written {len(samples)} samples to {len(writer.shards)} shards in {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,7 @@ def main():
     with lmdb.open(args.output, map_size=1099511627776) as env_out:
         in_samples = 0
         out_samples = 0
+        sizes = []  # (width, height) of each output sample
         samples_per_chunk = 1000
         for lmdb_in in args.inputs:
             with lmdb.open(lmdb_in, readonly=True, max_readers=1, lock=False) as env_in:
@@ -39,6 +40,7 @@ def main():
                                 print(f'Skipping: {index}, w = {w}, h = {h}')
                                 continue
                             out_samples += 1  # increment. start at 1
+                            sizes.append((w, h))
                             label_key = f'label-{index:09d}'.encode()
                             out_label_key = f'label-{out_samples:09d}'.encode()
                             out_image_key = f'image-{out_samples:09d}'.encode()
@@ -50,6 +52,7 @@ def main():
                     print(f'Written samples from {chunk[0]} to {chunk[-1]}')
         with env_out.begin(write=True) as txn:
             txn.put('num-samples'.encode(), str(out_samples).encode())
+            txn.put('size-index'.encode(), np.asarray(sizes, dtype='<u4').reshape(-1, 2).tobytes())
         print(f'Written {out_samples} samples to {args.output} out of {in_samples} input samples.')
 
 
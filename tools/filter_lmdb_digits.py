@@ -104,6 +104,7 @@ def main():
         in_samples = 0
         out_samples = 0
         samples_per_chunk = 1000
+        sizes = []  # (width, height) of each output sample
 
         # Set to track unique indices
         unique_indices = set()
@@ -180,6 +181,7 @@ def main():
 
                                 # If all checks pass, add to output
                                 out_samples += 1  # increment. start at 1
+                                sizes.append((w, h))
                                 out_image_key = f'image-{out_samples:09d}'.encode()
                                 out_label_key = f'label-{out_samples:09d}'.encode()
                                 cache[out_image_key] = image_bin
@@ -194,6 +196,7 @@ def main():
 
         with env_out.begin(write=True) as txn:
             txn.put('num-samples'.encode(), str(out_samples).encode())
+            txn.put('size-index'.encode(), np.asarray(sizes, dtype='<u4').reshape(-1, 2).tobytes())
         print(f'Written {out_samples} samples to {temp_output} out of {in_samples} input samples.')
 
             
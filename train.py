@@ -25,7 +25,8 @@ from omegaconf import DictConfig, open_dict
 import torch
 
 from pytorch_lightning import Trainer
-from pytorch_lightning.callbacks import ModelCheckpoint, # StochasticWeightAveraging # Removed SWA callback to avoid conflicts with OneCycleLR
+# StochasticWeightAveraging removed to avoid conflicts with OneCycleLR
+from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.loggers import TensorBoardLogger
 from pytorch_lightning.strategies import DDPStrategy
 from pytorch_lightning.utilities.model_summary import summarize